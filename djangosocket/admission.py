@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -
+
+"""
+Admission control of websocket upgrades.
+
+Upgrades are checked before the opening handshake is sent against the
+connections of the worker, the lag of the eventlet hub and the handshake
+rate, and are all rejected while the worker drains. Rejected upgrades get a
+503 response with a jittered Retry-After so that reconnecting clients spread
+out instead of coming back all at once.
+"""
+
+import random
+import time
+
+import eventlet
+
+from djangosocket.conf import settings
+from djangosocket.registry import registry
+from djangosocket.stream.ratelimit import TokenBucket
+
+__all__ = ('HubLagMonitor', 'AdmissionController', 'admission')
+
+
+class HubLagMonitor(object):
+    """
+    Measures how late the eventlet hub wakes up a greenthread sleeping for
+    interval seconds. A saturated hub runs every greenthread late.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lag      = 0.0
+        self._thread  = None
+
+    def start(self):
+        """
+        Start measuring, once per worker.
+        """
+
+        if self._thread is None:
+            self._thread = eventlet.spawn(self._run)
+
+    def _run(self):
+        while True:
+            start = time.time()
+            eventlet.sleep(self.interval)
+            self.lag = max(0.0, time.time() - start - self.interval)
+
+
+def _view_tag(view_func):
+    return ('djangosocket.view', view_func.__module__, view_func.__name__)
+
+
+class AdmissionController(object):
+    """
+    Decides whether a websocket upgrade may be accepted by the worker.
+    """
+
+    def __init__(self):
+        self.hub_lag = HubLagMonitor()
+        self.draining = False
+        self._handshakes = None
+
+    def check(self, view_func):
+        """
+        Return None if an upgrade for view_func may be accepted, otherwise
+        the number of seconds the client should wait before retrying.
+        """
+
+        if self.draining:
+            return self._retry_after()
+
+        max_connections = settings.DJANGOSOCKET_ADMISSION_MAX_CONNECTIONS
+        if max_connections is not None and len(registry) >= max_connections:
+            return self._retry_after()
+
+        max_view_connections = getattr(view_func, 'djangosocket_max_connections', None)
+        if max_view_connections is not None and \
+            registry.count(tag=_view_tag(view_func)) >= max_view_connections:
+            return self._retry_after()
+
+        max_hub_lag = settings.DJANGOSOCKET_ADMISSION_MAX_HUB_LAG
+        if max_hub_lag is not None:
+            self.hub_lag.start()
+            if self.hub_lag.lag > max_hub_lag:
+                return self._retry_after()
+
+        rate = settings.DJANGOSOCKET_ADMISSION_HANDSHAKE_RATE
+        if rate:
+            if self._handshakes is None:
+                self._handshakes = TokenBucket(rate, settings.DJANGOSOCKET_ADMISSION_HANDSHAKE_BURST)
+            if self._handshakes.delay():
+                return self._retry_after()
+            self._handshakes.consume(1)
+        return None
+
+    def admitted(self, websocket, view_func):
+        """
+        Account for a connection accepted for view_func.
+        """
+
+        if getattr(view_func, 'djangosocket_max_connections', None) is not None:
+            registry.tag(websocket, _view_tag(view_func))
+
+    def _retry_after(self):
+        """
+        Return a Retry-After delay, jittered up to twice the configured one.
+        """
+
+        retry_after = settings.DJANGOSOCKET_ADMISSION_RETRY_AFTER
+        return int(retry_after + random.random() * retry_after) or 1
+
+
+admission = AdmissionController()
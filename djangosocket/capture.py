@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -
+
+"""
+Capture of websocket traffic for offline replay.
+
+When DJANGOSOCKET_CAPTURE_DIR is set, each worker appends the frames of its
+connections (a DJANGOSOCKET_CAPTURE_SAMPLE fraction of them) to a capture
+file of that directory. Captures contain message payloads, only enable them
+where recording user data is acceptable.
+
+A capture file starts with MAGIC, followed by records made of a RECORD
+header and a payload::
+
+    session id, kind, opcode, timestamp, payload length
+
+An OPEN record carries the path and protocol of the connection separated by
+a newline; INBOUND and OUTBOUND records a frame with its hybi opcode and FIN
+bit, hixie76 frames being recorded as text and close frames; CLOSE ends the
+session.
+
+Records are buffered in memory and written by a single greenthread through
+the eventlet thread pool, at least every FLUSH_INTERVAL seconds, so that
+capturing never blocks the hub on disk I/O.
+
+Captured sessions are replayed by ``python -m djangosocket.utils.playback``.
+"""
+
+import atexit
+import itertools
+import logging
+import os
+import random
+import struct
+import time
+
+import eventlet
+from eventlet import tpool
+
+from djangosocket.conf import settings
+
+__all__ = ('CaptureFile', 'CaptureSession', 'Session', 'session', 'read', 'sessions',
+           'OPEN', 'INBOUND', 'OUTBOUND', 'CLOSE')
+
+MAGIC = 'DSCAP\x02'
+# files of the first version recorded opcodes without the FIN bit
+_MAGIC_V1 = 'DSCAP\x01'
+RECORD = struct.Struct('!IBBdI')
+FIN = 0x80
+
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 65536
+
+OPEN = 0
+INBOUND = 1
+OUTBOUND = 2
+CLOSE = 3
+
+logger = logging.getLogger('djangosocket.capture')
+
+_file = None
+
+
+class CaptureFile(object):
+    """
+    Append-only capture file shared by the connections of a worker.
+    """
+
+    def __init__(self, path):
+        self.path    = path
+        self._file   = open(path, 'ab')
+        self._ids    = itertools.count(1)
+        self._buffer = []
+        self._size   = 0
+        self._writer = None
+        self._busy   = False
+        if not self._file.tell():
+            self._file.write(MAGIC)
+
+    def session(self, path, protocol=''):
+        """
+        Start recording a connection and return its CaptureSession.
+        """
+
+        session = CaptureSession(self, self._ids.next())
+        session.record(OPEN, 0, '%s\n%s' % (path, protocol))
+        return session
+
+    def write(self, session_id, kind, opcode, payload):
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        record = RECORD.pack(session_id, kind, opcode, time.time(), len(payload)) + payload
+        self._buffer.append(record)
+        self._size += len(record)
+        if self._writer is None:
+            self._writer = eventlet.spawn_after(FLUSH_INTERVAL, self._write_buffer)
+        elif self._size >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered records now rather than at the next interval.
+        """
+
+        if self._writer is not None and not self._busy:
+            self._writer.cancel()
+            self._writer = eventlet.spawn(self._write_buffer)
+
+    def _write_buffer(self):
+        # the only writer, records are written in order
+        self._busy = True
+        try:
+            while self._buffer:
+                data = ''.join(self._buffer)
+                self._buffer = []
+                self._size = 0
+                tpool.execute(self._write, data)
+        except EnvironmentError, e:
+            logger.error('Capture to %s failed: %s', self.path, e)
+        finally:
+            self._busy = False
+            self._writer = None
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    def close(self):
+        """
+        Write the records still buffered and close the file, blocking.
+        """
+
+        if self._writer is not None and not self._busy:
+            self._writer.cancel()
+        data, self._buffer = ''.join(self._buffer), []
+        self._write(data)
+        self._file.close()
+
+
+class CaptureSession(object):
+    """
+    Records the frames of a connection.
+    """
+
+    def __init__(self, capture, session_id):
+        self._capture = capture
+        self.id       = session_id
+
+    def record(self, kind, opcode, payload='', fin=True):
+        self._capture.write(self.id, kind, fin and opcode | FIN or opcode, payload)
+
+    def close(self):
+        self._capture.write(self.id, CLOSE, 0, '')
+
+
+def session(request):
+    """
+    Return a CaptureSession for the connection of request, or None when
+    it is not captured.
+    """
+
+    global _file
+    directory = settings.DJANGOSOCKET_CAPTURE_DIR
+    if not directory or random.random() >= settings.DJANGOSOCKET_CAPTURE_SAMPLE:
+        return None
+    if _file is None:
+        path = os.path.join(directory, 'djangosocket-%d-%d.cap' % (os.getpid(), time.time()))
+        logger.info('Capturing websocket traffic to %s', path)
+        _file = CaptureFile(path)
+        atexit.register(_file.close)
+
+    meta = getattr(request, 'META', {})
+    path = getattr(request, 'path', '')
+    query = meta.get('QUERY_STRING')
+    if query:
+        path = '%s?%s' % (path, query)
+    return _file.session(path, meta.get('HTTP_SEC_WEBSOCKET_PROTOCOL', ''))
+
+
+def read(path):
+    """
+    Generate the (session id, kind, opcode, timestamp, payload) records of
+    capture file path, opcodes of frames carrying the FIN bit.
+    """
+
+    capture = open(path, 'rb')
+    try:
+        magic = capture.read(len(MAGIC))
+        if magic not in (MAGIC, _MAGIC_V1):
+            raise ValueError('%s is not a capture file' % path)
+        fin = magic == _MAGIC_V1 and FIN or 0
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                # a worker may have been killed in the middle of a record
+                return
+            session_id, kind, opcode, timestamp, length = RECORD.unpack(header)
+            payload = capture.read(length)
+            if len(payload) < length:
+                return
+            if kind in (INBOUND, OUTBOUND):
+                opcode |= fin
+            yield session_id, kind, opcode, timestamp, payload
+    finally:
+        capture.close()
+
+
+class Session(object):
+    """
+    Connection read back from a capture file. frames is the list of
+    (timestamp, kind, opcode, fin, payload) of its INBOUND and OUTBOUND
+    frames.
+    """
+
+    def __init__(self, path, protocol, start):
+        self.path     = path
+        self.protocol = protocol
+        self.start    = start
+        self.frames   = []
+
+
+def sessions(paths):
+    """
+    Return the sessions of capture files paths, by start time.
+    """
+
+    result = []
+    for path in paths:
+        opened = {}
+        for session_id, kind, opcode, timestamp, payload in read(path):
+            if kind == OPEN:
+                request_path, protocol = (payload.split('\n', 1) + [''])[:2]
+                opened[session_id] = Session(request_path, protocol, timestamp)
+                result.append(opened[session_id])
+            elif kind == CLOSE:
+                opened.pop(session_id, None)
+            elif session_id in opened:
+                opened[session_id].frames.append((timestamp, kind, opcode & 0x0f,
+                                                  bool(opcode & FIN), payload))
+    result.sort(key=lambda session: session.start)
+    return result
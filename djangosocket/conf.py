@@ -1,11 +1,56 @@
 # -*- coding: utf-8 -
 
 from django.conf import settings as global_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
 from djangosocket.utils.settings import AppSettings
 
 
 class DjangoSocketSettings(AppSettings):
     ACCEPT_ALL = False
-    MIDDLEWARE_INSTALLED = 'djangosocket.middleware.DjangoSocketMiddleware' in global_settings.MIDDLEWARE_CLASSES
+    MUX_INITIAL_CREDIT = 64
+    MUX_MAX_CHANNELS = 32
+    RATE_LIMIT_MESSAGES = None
+    RATE_LIMIT_BYTES = None
+    RATE_LIMIT_IP_MESSAGES = None
+    RATE_LIMIT_IP_BYTES = None
+    RATE_LIMIT_BURST = 1.0
+    RATE_LIMIT_POLICY = 'pause'
+    RATE_LIMIT_TRUSTED_PROXIES = ()
+    ADMISSION_MAX_CONNECTIONS = None
+    ADMISSION_MAX_HUB_LAG = None
+    ADMISSION_HANDSHAKE_RATE = None
+    ADMISSION_HANDSHAKE_BURST = 1.0
+    ADMISSION_RETRY_AFTER = 5
+    DB_RELEASE = False
+    DB_RELEASE_AFTER = 1.0
+    DB_POOL_SIZE = 10
+    REPLAY_BUFFER_SIZE = 1000
+    REPLAY_BUFFER_BYTES = 1048576
+    REPLAY_MAX_AGE = 300
+    REPLAY_MAX_BYTES = 67108864
+    OUTBOUND_BULK_THRESHOLD = None
+    OUTBOUND_FRAGMENT_SIZE = 16384
+    OUTBOUND_MAX_QUEUE = 1000
+    TRACE_HUB_BLOCK_MS = None
+    DRAIN_TIMEOUT = 10
+    DRAIN_BATCH_SIZE = 100
+    DRAIN_BATCH_INTERVAL = 0.1
+    DRAIN_RECONNECT_WINDOW = 30
+    CAPTURE_DIR = None
+    CAPTURE_SAMPLE = 1.0
+    PING_INTERVAL = None
+    MIDDLEWARE_INSTALLED = None
 
-settings = DjangoSocketSettings(prefix="DJANGOSOCKET")
\ No newline at end of file
+    def configure_middleware_installed(self, value):
+        if value is None:
+            value = 'djangosocket.middleware.DjangoSocketMiddleware' in global_settings.MIDDLEWARE_CLASSES
+        return value
+
+    def configure_rate_limit_policy(self, value):
+        if value not in ('pause', 'close'):
+            raise ImproperlyConfigured("DJANGOSOCKET_RATE_LIMIT_POLICY must be 'pause' or 'close'")
+        return value
+
+# resolved on first access rather than when djangosocket is imported
+settings = SimpleLazyObject(lambda: DjangoSocketSettings(prefix="DJANGOSOCKET"))
\ No newline at end of file
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -
+
+"""
+Database connection lifecycle of long-lived websocket views.
+
+A websocket view stays inside a single Django request for the whole life of
+its connection. With DJANGOSOCKET_DB_RELEASE enabled, the connections of a
+view are closed once it has been waiting DJANGOSOCKET_DB_RELEASE_AFTER
+seconds for messages, so that idle sockets don't pin a database connection
+while bursts of messages still reuse it. Django reopens connections lazily
+on the next query.
+
+Database work can also be bounded explicitly: checkout() and run_in_thread()
+hold a slot of a per-worker pool of DJANGOSOCKET_DB_POOL_SIZE slots, so that
+at most that many greenthreads of a worker have a connection open at once.
+"""
+
+import contextlib
+import logging
+
+from eventlet import semaphore
+
+from djangosocket.conf import settings
+
+__all__ = ('ConnectionGuard', 'checkout', 'close_connections', 'guard', 'run_in_thread')
+
+logger = logging.getLogger('djangosocket.db')
+
+_pool = None
+
+
+def close_connections():
+    """
+    Close the database connections of the current greenthread, leaving
+    connections inside a managed transaction alone.
+    """
+
+    from django.db import connections
+    for connection in connections.all():
+        if connection.is_managed():
+            logger.debug('Keeping connection %s open inside a transaction', connection.alias)
+            continue
+        connection.close()
+
+
+class ConnectionGuard(object):
+    """
+    Closes the connections of a view which has been waiting for messages
+    for release_after seconds.
+    """
+
+    def __init__(self, release_after):
+        self.release_after = release_after
+        self.used          = False
+
+    def busy(self):
+        """
+        Called before messages are handed to the view.
+        """
+
+        self.used = True
+
+    def idle(self):
+        """
+        Called once the view has been waiting release_after seconds, or
+        when it returns.
+        """
+
+        self.used = False
+        close_connections()
+
+
+def guard():
+    """
+    Return a ConnectionGuard for a new connection, or None unless
+    releasing database connections is enabled.
+    """
+
+    if not settings.DJANGOSOCKET_DB_RELEASE:
+        return None
+    return ConnectionGuard(settings.DJANGOSOCKET_DB_RELEASE_AFTER)
+
+
+def _slot():
+    global _pool
+    size = settings.DJANGOSOCKET_DB_POOL_SIZE
+    if size and _pool is None:
+        _pool = semaphore.Semaphore(size)
+    return _pool
+
+
+@contextlib.contextmanager
+def checkout():
+    """
+    Hold a slot of the worker pool while using the database::
+
+        with checkout():
+            Event.objects.create(data=message)
+
+    Connections opened inside the block are closed when it ends, so that
+    the pool bounds the open connections of the worker.
+    """
+
+    pool = _slot()
+    if pool is not None:
+        pool.acquire()
+    try:
+        yield
+    finally:
+        try:
+            close_connections()
+        finally:
+            if pool is not None:
+                pool.release()
+
+
+def run_in_thread(func, *args, **kwargs):
+    """
+    Run blocking ORM or CPU bound work in eventlet's thread pool without
+    stalling the hub, holding a slot of the worker pool, and return its
+    result. Connections opened by func are closed before returning.
+    """
+
+    from eventlet import tpool
+
+    def call():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_connections()
+    pool = _slot()
+    if pool is not None:
+        pool.acquire()
+    try:
+        return tpool.execute(call)
+    finally:
+        if pool is not None:
+            pool.release()
@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -
-from gunicorn.workers.async import ALREADY_HANDLED
 
-from django.http import HttpResponse
 from django.utils.decorators import decorator_from_middleware
 
 from djangosocket.conf import settings
-from djangosocket.middleware import DjangoSocketMiddleware
+from djangosocket.utils import already_handled
 
 __all__ = ('accept_djangosocket', 'require_djangosocket')
 
@@ -14,32 +12,51 @@ def _setup_djangosocket(func):
     from functools import wraps
     @wraps(func)
     def new_func(request, *args, **kwargs):
-        response = func(request, *args, **kwargs)
+        try:
+            response = func(request, *args, **kwargs)
+        finally:
+            guard = getattr(getattr(request, 'websocket', None), 'db_guard', None)
+            if guard is not None:
+                # don't leave connections open even if the view failed
+                guard.idle()
         if response is None and request.is_websocket():
-            return ALREADY_HANDLED
+            return already_handled()
         return response
     if not settings.DJANGOSOCKET_MIDDLEWARE_INSTALLED:
+        from djangosocket.middleware import DjangoSocketMiddleware
         decorator = decorator_from_middleware(DjangoSocketMiddleware)
         new_func = decorator(new_func)
     return new_func
 
 
-def accept_djangosocket(func):
+def accept_djangosocket(func=None, max_connections=None):
     """
     Decorator for views that accept websocket object.
+    
+    max_connections limits the connections the view may hold per worker,
+    further upgrades get rejected by admission control.
     """
     
+    if func is None:
+        return lambda func: accept_djangosocket(func, max_connections=max_connections)
+    func.djangosocket_max_connections = max_connections
     func.accept_djangosocket = True
     func.require_djangosocket = getattr(func, 'require_djangosocket', False)
     func = _setup_djangosocket(func)
     return func
 
 
-def require_djangosocket(func):
+def require_djangosocket(func=None, max_connections=None):
     """
     Decorator for views that require websocket object.
+    
+    max_connections limits the connections the view may hold per worker,
+    further upgrades get rejected by admission control.
     """
     
+    if func is None:
+        return lambda func: require_djangosocket(func, max_connections=max_connections)
+    func.djangosocket_max_connections = max_connections
     func.accept_djangosocket = True
     func.require_djangosocket = True
     func = _setup_djangosocket(func)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -
+
+"""
+Graceful drain of the websocket connections of a worker.
+
+Draining stops admitting upgrades, then closes live connections in paced
+batches with a going away (1001) or service restart (1012) status. The close
+reason carries a jittered reconnect hint, ``reconnect=<seconds>``, so that
+clients spread their reconnects instead of all coming back in the same
+second. Call it when a worker is shutting down, e.g. from a gunicorn
+``worker_int`` hook::
+
+    from djangosocket.drain import drain
+
+    def worker_int(worker):
+        drain()
+"""
+
+import logging
+import random
+import time
+
+import eventlet
+
+from djangosocket.admission import admission
+from djangosocket.conf import settings
+from djangosocket.registry import registry
+from djangosocket.stream import const
+
+__all__ = ('drain', 'start_drain')
+
+logger = logging.getLogger('djangosocket.drain')
+
+
+def drain(code=const.STATUS_SERVICE_RESTART, timeout=None):
+    """
+    Close every connection of the worker and wait up to timeout seconds
+    (DJANGOSOCKET_DRAIN_TIMEOUT by default) for clients to acknowledge.
+    Returns the number of acknowledged closes.
+    """
+
+    if timeout is None:
+        timeout = settings.DJANGOSOCKET_DRAIN_TIMEOUT
+    deadline = time.time() + timeout
+    batch_size = settings.DJANGOSOCKET_DRAIN_BATCH_SIZE
+    window = settings.DJANGOSOCKET_DRAIN_RECONNECT_WINDOW
+
+    admission.draining = True
+    # logical channels go away with their physical connection
+    connections = [c for c in registry.connections() if hasattr(c, 'drain_close')]
+    logger.info('Draining %d connections', len(connections))
+
+    for i, connection in enumerate(connections):
+        reason = 'reconnect=%.1f' % (random.random() * window)
+        # writing the close may block on a slow client or a view mid-write
+        eventlet.spawn_n(_close, connection, code, reason, deadline)
+        if (i + 1) % batch_size == 0:
+            eventlet.sleep(settings.DJANGOSOCKET_DRAIN_BATCH_INTERVAL)
+
+    pending = connections
+    while pending and time.time() < deadline:
+        eventlet.sleep(0.05)
+        pending = [c for c in pending if not c.close_acknowledged]
+
+    acknowledged = len(connections) - len(pending)
+    logger.info('Drained %d connections, %d acknowledged', len(connections), acknowledged)
+    return acknowledged
+
+
+def _close(connection, code, reason, deadline):
+    with eventlet.Timeout(max(deadline - time.time(), 0), False):
+        connection.drain_close(code, reason, deadline)
+
+
+def start_drain(code=const.STATUS_SERVICE_RESTART, timeout=None):
+    """
+    Drain in a greenthread and return it.
+    """
+
+    return eventlet.spawn(drain, code, timeout)
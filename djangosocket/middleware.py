@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -
 
-from django.http import HttpResponseBadRequest
-
-from gunicorn.workers.async import ALREADY_HANDLED
+from django.http import HttpResponse, HttpResponseBadRequest
 
+from djangosocket import db
+from djangosocket.admission import admission
 from djangosocket.conf import settings
+from djangosocket.registry import registry
+from djangosocket.stream.base import HandshakeException
+from djangosocket.stream.mux import LogicalChannel
+from djangosocket.utils import already_handled
 from djangosocket.websocket import setup_djangosocket, MalformedWebSocket
 
 
@@ -21,6 +25,9 @@ class DjangoSocketMiddleware(object):
         - Return Bad Request Response (400) if view require a websocket (require_djangosocket)
           and no websocket object exists in Request
          
+        - Return Service Unavailable Response (503) with a Retry-After header if the
+          worker is over its admission limits
+         
         - If "websocket" exists in Request, return a an ALREADY_HANDLED object as
           response to prevent barf on the fact that socket doesn't call response
     """
@@ -31,9 +38,12 @@ class DjangoSocketMiddleware(object):
         a Bad Request Response (400)
         """
         
+        if getattr(request, 'websocket', None) is not None:
+            # already set up, e.g. request of a multiplexed logical channel
+            return
         try:
             request.websocket = setup_djangosocket(request)
-            request.is_websocket = lambda: True
+            request.is_websocket = lambda: bool(request.websocket)
         except MalformedWebSocket, e:
             request.websocket = None
             request.is_websocket = lambda: False
@@ -47,6 +57,10 @@ class DjangoSocketMiddleware(object):
         
         Return Bad Request Response (400) if view require a websocket (require_djangosocket)
         and no websocket object exists in Request
+        
+        Return Service Unavailable Response (503) if the upgrade is rejected by
+        admission control. Logical channels of multiplexed connections are
+        not checked, their connection was admitted.
         """
         
         # open websocket if its an accepted request
@@ -55,8 +69,26 @@ class DjangoSocketMiddleware(object):
             if not settings.DJANGOSOCKET_ACCEPT_ALL and \
                 not getattr(view_func, 'accept_djangosocket', False):
                 return HttpResponseBadRequest()
+            channel = isinstance(request.websocket, LogicalChannel)
+            # shed load before committing to the connection
+            retry_after = not channel and admission.check(view_func) or None
+            if retry_after is not None:
+                request.websocket.closed = True
+                request.is_websocket = lambda: False
+                response = HttpResponse(status=503)
+                response['Retry-After'] = str(retry_after)
+                return response
             # everything is fine .. so prepare connection by sending handshake
-            request.websocket.do_handshake()
+            try:
+                request.websocket.do_handshake()
+            except HandshakeException, e:
+                request.websocket.closed = True
+                request.is_websocket = lambda: False
+                return HttpResponseBadRequest(str(e))
+            if not channel:
+                admission.admitted(request.websocket, view_func)
+            # don't pin database connections while waiting for messages
+            request.websocket.db_guard = db.guard()
         elif getattr(view_func, 'require_djangosocket', False):
             # websocket was required but not provided
             return HttpResponseBadRequest()
@@ -68,4 +100,10 @@ class DjangoSocketMiddleware(object):
         """
         
         if request.is_websocket():
-            return ALREADY_HANDLED
\ No newline at end of file
+            # the view is done with the connection, release what the stream
+            # holds even if the client didn't close it
+            request.websocket.closed = True
+            registry.unregister(request.websocket)
+            if request.websocket.db_guard is not None:
+                request.websocket.db_guard.idle()
+            return already_handled()
\ No newline at end of file
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -
+
+"""
+Per-worker registry of live websocket connections.
+
+Connections are registered when their opening handshake is sent and removed
+as soon as they get closed. They are indexed by user id, session key, path
+and arbitrary tags so that lookups and presence counts never need to scan
+every connection::
+
+    from djangosocket.registry import registry
+
+    registry.tag(request.websocket, 'ticker')
+    registry.count(path='/live/ticker/')
+    registry.send(message, user=42)
+"""
+
+import logging
+
+__all__ = ('ConnectionRegistry', 'registry')
+
+INDEX_USER = 'user'
+INDEX_SESSION = 'session'
+INDEX_PATH = 'path'
+INDEX_TAG = 'tag'
+
+
+class ConnectionRegistry(object):
+    """
+    Index of connections by user id, session key, path and tags.
+    """
+
+    def __init__(self):
+        self._logger      = logging.getLogger('djangosocket.registry')
+        self._connections = set()
+        self._keys        = {}
+        self._indexes     = {
+            INDEX_USER: {},
+            INDEX_SESSION: {},
+            INDEX_PATH: {},
+            INDEX_TAG: {},
+        }
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, connection):
+        return connection in self._connections
+
+    def _add(self, connection, index, key):
+        self._indexes[index].setdefault(key, set()).add(connection)
+        self._keys[connection].add((index, key))
+
+    def _discard(self, connection, index, key):
+        bucket = self._indexes[index].get(key)
+        if bucket is not None:
+            bucket.discard(connection)
+            if not bucket:
+                # drop empty buckets so that the indexes stay bounded
+                del self._indexes[index][key]
+
+    def register(self, connection, request=None):
+        """
+        Register connection, indexing it by the user, session and path of
+        request when available.
+        """
+
+        if connection in self._connections:
+            return
+        self._connections.add(connection)
+        self._keys[connection] = set()
+        if request is None:
+            return
+
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            self._add(connection, INDEX_USER, user.pk)
+        session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+        if session_key:
+            self._add(connection, INDEX_SESSION, session_key)
+        self._add(connection, INDEX_PATH, request.path)
+
+    def unregister(self, connection):
+        """
+        Remove connection from every index. Unknown connections are ignored.
+        """
+
+        keys = self._keys.pop(connection, None)
+        if keys is None:
+            return
+        self._connections.discard(connection)
+        for index, key in keys:
+            self._discard(connection, index, key)
+
+    def tag(self, connection, *tags):
+        """
+        Add tags to a registered connection.
+        """
+
+        if connection not in self._connections:
+            return
+        for tag in tags:
+            self._add(connection, INDEX_TAG, tag)
+
+    def untag(self, connection, *tags):
+        """
+        Remove tags from a registered connection.
+        """
+
+        keys = self._keys.get(connection)
+        if keys is None:
+            return
+        for tag in tags:
+            keys.discard((INDEX_TAG, tag))
+            self._discard(connection, INDEX_TAG, tag)
+
+    def _buckets(self, user, session, path, tag):
+        criteria = ((INDEX_USER, user), (INDEX_SESSION, session),
+                    (INDEX_PATH, path), (INDEX_TAG, tag))
+        return [self._indexes[index].get(key, ()) for index, key in criteria
+                if key is not None]
+
+    def connections(self, user=None, session=None, path=None, tag=None):
+        """
+        Return a list of the connections matching every given criterion, or
+        all connections when no criterion is given.
+        """
+
+        buckets = self._buckets(user, session, path, tag)
+        if not buckets:
+            return list(self._connections)
+        buckets.sort(key=len)
+        smallest, others = buckets[0], buckets[1:]
+        return [c for c in smallest if all(c in bucket for bucket in others)]
+
+    def count(self, user=None, session=None, path=None, tag=None):
+        """
+        Return the number of connections matching every given criterion.
+        Counting on a single criterion doesn't iterate over connections.
+        """
+
+        buckets = self._buckets(user, session, path, tag)
+        if not buckets:
+            return len(self._connections)
+        if len(buckets) == 1:
+            return len(buckets[0])
+        return len(self.connections(user, session, path, tag))
+
+    def send(self, message, user=None, session=None, path=None, tag=None, priority=None):
+        """
+        Send message, with the outbound priority if given, to the
+        connections matching every given criterion. Returns the number of
+        connections the message was sent to.
+        """
+
+        sent = 0
+        for connection in self.connections(user, session, path, tag):
+            if connection.closed:
+                continue
+            try:
+                connection.send(message, priority=priority)
+            except Exception, e:
+                self._logger.debug('Targeted send failed: %s', e)
+                continue
+            sent += 1
+        return sent
+
+
+registry = ConnectionRegistry()
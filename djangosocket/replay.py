@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -
+
+"""
+Resumable subscriptions backed by per-channel replay ring buffers.
+
+Messages published on a channel are tagged with a cursor made of the epoch
+of the channel buffer and a monotonic sequence number, and the most recent
+ones are kept in a bounded ring buffer. Buffers whose messages all expired
+are dropped, and the least recently published ones are dropped when all
+buffers together hold more than DJANGOSOCKET_REPLAY_MAX_BYTES. A reconnecting client passes the
+last cursor it has seen when subscribing again and only gets the messages
+it missed, or is told to resync when they are no longer buffered.
+
+Messages are sent as::
+
+    <epoch>-<seq>,<channel>,<payload>
+
+and a client that has to fetch the full state again receives::
+
+    resync,<channel>,<current cursor>
+"""
+
+import binascii
+import collections
+import itertools
+import os
+import time
+
+from djangosocket.conf import settings
+from djangosocket.registry import registry
+
+__all__ = ('ReplayBuffer', 'ReplayChannels', 'channels')
+
+RESYNC = 'resync'
+
+
+class ReplayBuffer(object):
+    """
+    Ring buffer of the most recent messages of a channel, bounded in number
+    of messages, bytes and age.
+    """
+
+    def __init__(self, size, max_bytes, max_age, owner=None):
+        self.epoch     = binascii.hexlify(os.urandom(4))
+        self.last_seq  = 0
+        self.last_used = time.time()
+        self.size      = size
+        self.max_bytes = max_bytes
+        self.max_age   = max_age
+        self._bytes    = 0
+        self._messages = collections.deque()
+        self._owner    = owner
+
+    def __len__(self):
+        return self._bytes
+
+    def _account(self, delta):
+        self._bytes += delta
+        if self._owner is not None:
+            self._owner.bytes += delta
+
+    def cursor(self, seq=None):
+        """
+        Return the cursor of seq, by default of the last message.
+        """
+
+        if seq is None:
+            seq = self.last_seq
+        return '%s-%d' % (self.epoch, seq)
+
+    def _expire(self, now):
+        messages = self._messages
+        deadline = now - self.max_age
+        while messages and (len(messages) > self.size or self._bytes > self.max_bytes or
+                            messages[0][1] < deadline):
+            self._account(-len(messages.popleft()[2]))
+
+    def append(self, message):
+        """
+        Buffer message and return its sequence number.
+        """
+
+        self.last_seq += 1
+        self.last_used = time.time()
+        self._messages.append((self.last_seq, self.last_used, message))
+        self._account(len(message))
+        self._expire(self.last_used)
+        return self.last_seq
+
+    def expired(self, now):
+        """
+        Return True if every message of the buffer is past its max age.
+        """
+
+        return self.last_used < now - self.max_age
+
+    def since(self, cursor):
+        """
+        Return the (seq, message) pairs published after cursor, or None if
+        the client has to resync: unknown epoch or messages no longer
+        buffered.
+        """
+
+        try:
+            epoch, seq = cursor.rsplit('-', 1)
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or seq > self.last_seq:
+            return None
+        if seq == self.last_seq:
+            return []
+
+        self._expire(time.time())
+        if not self._messages or seq + 1 < self._messages[0][0]:
+            return None
+        start = seq + 1 - self._messages[0][0]
+        return [(s, m) for s, stamp, m in itertools.islice(self._messages, start, None)]
+
+
+class ReplayChannels(object):
+    """
+    Named channels publishing to the connections subscribed to them.
+    """
+
+    # seconds between two sweeps of expired buffers
+    sweep_interval = 60
+
+    def __init__(self):
+        self._buffers = {}
+        self._swept   = time.time()
+        # bytes held by all buffers
+        self.bytes    = 0
+
+    def buffer(self, channel):
+        """
+        Return the replay buffer of channel.
+        """
+
+        buffer = self._buffers.get(channel)
+        if buffer is None:
+            buffer = self._buffers[channel] = ReplayBuffer(
+                settings.DJANGOSOCKET_REPLAY_BUFFER_SIZE,
+                settings.DJANGOSOCKET_REPLAY_BUFFER_BYTES,
+                settings.DJANGOSOCKET_REPLAY_MAX_AGE,
+                owner=self)
+        return buffer
+
+    def _drop(self, channel):
+        buffer = self._buffers.pop(channel)
+        self.bytes -= len(buffer)
+
+    def _evict(self, keep):
+        """
+        Drop buffers whose messages all expired, then the least recently
+        published ones while over DJANGOSOCKET_REPLAY_MAX_BYTES.
+        """
+
+        now = time.time()
+        if now - self._swept > self.sweep_interval:
+            self._swept = now
+            for channel, buffer in self._buffers.items():
+                if buffer.expired(now) and channel != keep:
+                    self._drop(channel)
+
+        max_bytes = settings.DJANGOSOCKET_REPLAY_MAX_BYTES
+        if max_bytes and self.bytes > max_bytes:
+            by_use = sorted([(b.last_used, c) for c, b in self._buffers.items() if c != keep])
+            for last_used, channel in by_use:
+                if self.bytes <= max_bytes:
+                    break
+                self._drop(channel)
+
+    def _encode(self, buffer, seq, channel, message):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        return '%s,%s,%s' % (buffer.cursor(seq), channel, message)
+
+    def publish(self, channel, message):
+        """
+        Buffer message and send it to the subscribers of channel. Returns
+        the number of connections it was sent to.
+        """
+
+        buffer = self.buffer(channel)
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        seq = buffer.append(message)
+        self._evict(channel)
+        return registry.send(self._encode(buffer, seq, channel, message),
+                             tag=_channel_tag(channel))
+
+    def subscribe(self, websocket, channel, cursor=None):
+        """
+        Subscribe websocket to channel. When the client resumes from cursor,
+        the messages it missed are sent first, or a resync notice if they
+        are no longer buffered.
+        """
+
+        buffer = self.buffer(channel)
+        if cursor is not None:
+            seq = None
+            # sending may yield to publishers, loop until nothing is missing
+            while seq != buffer.last_seq:
+                missed = buffer.since(cursor)
+                if missed is None:
+                    websocket.send('%s,%s,%s' % (RESYNC, channel, buffer.cursor()))
+                    missed = [(buffer.last_seq, None)]
+                for seq, message in missed:
+                    if message is not None:
+                        websocket.send(self._encode(buffer, seq, channel, message))
+                    cursor = buffer.cursor(seq)
+                if not missed:
+                    break
+        registry.tag(websocket, _channel_tag(channel))
+
+    def unsubscribe(self, websocket, channel):
+        """
+        Stop sending messages of channel to websocket.
+        """
+
+        registry.untag(websocket, _channel_tag(channel))
+
+
+def _channel_tag(channel):
+    return ('djangosocket.replay', channel)
+
+
+channels = ReplayChannels()
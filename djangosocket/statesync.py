@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -
+
+"""
+Snapshot plus delta synchronisation of JSON documents.
+
+Instead of resending a whole document on every change, the server keeps the
+last version sent and only sends a structural diff of it. A client receives
+the full document when it joins::
+
+    snapshot,<name>,<seq>,<document>
+
+and then the changes of each version::
+
+    delta,<name>,<seq>,<changes>
+
+where changes is a list of ``[path, value]`` to set and ``[path]`` to
+delete, path being the list of keys and indexes leading to the value. A
+delta applies to version seq - 1 only; a client seeing a gap in sequence
+numbers sends ``resync,<name>`` and the view calls resync() to get a new
+snapshot.
+
+StateSync keeps the document of a single connection. StateChannels shares
+documents between the connections subscribed to them, computing and
+encoding each diff once for all of the subscribers. Snapshots and deltas
+are sent with the same outbound priority so that they arrive in order.
+"""
+
+import json
+
+from djangosocket.registry import registry
+from djangosocket.stream.outbound import PRIORITY_INTERACTIVE
+
+__all__ = ('diff', 'patch', 'StateDocument', 'StateSync', 'StateChannels', 'states')
+
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+RESYNC = 'resync'
+
+_MISSING = object()
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _kind(value):
+    # ints and longs are the same JSON number, bools and floats are not
+    if type(value) is int:
+        return long
+    return type(value)
+
+
+def _same(old, new):
+    """
+    Return True if old and new are the same JSON value. Unlike ==, True
+    differs from 1 and 1 from 1.0.
+    """
+
+    if old != new or _kind(old) is not _kind(new):
+        return False
+    if isinstance(new, dict):
+        for key, value in new.iteritems():
+            if not _same(old[key], value):
+                return False
+    elif isinstance(new, list):
+        for i in xrange(len(new)):
+            if not _same(old[i], new[i]):
+                return False
+    return True
+
+
+def _diff(old, new, path, changes):
+    if _kind(old) is not _kind(new):
+        changes.append([path, new])
+    elif isinstance(new, dict):
+        for key, value in new.iteritems():
+            previous = old.get(key, _MISSING)
+            if previous is _MISSING:
+                changes.append([path + [key], value])
+            elif not _same(previous, value):
+                _diff(previous, value, path + [key], changes)
+        for key in old:
+            if key not in new:
+                changes.append([path + [key]])
+    elif isinstance(new, list) and len(old) == len(new):
+        for i in xrange(len(new)):
+            if not _same(old[i], new[i]):
+                _diff(old[i], new[i], path + [i], changes)
+    elif old != new:
+        changes.append([path, new])
+
+
+def diff(old, new):
+    """
+    Return the changes turning JSON document old into new. Lists whose
+    length changed are replaced as a whole.
+    """
+
+    changes = []
+    _diff(old, new, [], changes)
+    return changes
+
+
+def patch(document, changes):
+    """
+    Apply changes to document, in place when possible, and return the
+    patched document.
+    """
+
+    for change in changes:
+        path = change[0]
+        if not path:
+            document = change[1]
+            continue
+        parent = document
+        for key in path[:-1]:
+            parent = parent[key]
+        if len(change) == 1:
+            del parent[path[-1]]
+        else:
+            parent[path[-1]] = change[1]
+    return document
+
+
+class StateDocument(object):
+    """
+    Versioned JSON document with the encoded snapshot of its current
+    version and delta from the previous one.
+    """
+
+    def __init__(self, name, document=None):
+        self.name      = name
+        self.document  = document
+        self.seq       = 0
+        self._snapshot = None
+
+    def update(self, document):
+        """
+        Make document the current version and return the encoded message
+        to send to clients holding the previous one, or None if nothing
+        changed.
+        """
+
+        encoded = _dumps(document)
+        # compare and keep the JSON form, tuples become lists and the
+        # caller may mutate its structures afterwards
+        document = json.loads(encoded)
+        if self.seq and _same(self.document, document):
+            return None
+        previous = self.document
+        self.document = document
+        self.seq += 1
+        self._snapshot = '%s,%s,%d,%s' % (SNAPSHOT, self.name, self.seq, encoded)
+        if self.seq == 1:
+            return self._snapshot
+
+        delta = _dumps(diff(previous, document))
+        # changing most of a document is cheaper to send whole
+        if len(delta) >= len(encoded):
+            return self._snapshot
+        return '%s,%s,%d,%s' % (DELTA, self.name, self.seq, delta)
+
+    def snapshot(self):
+        """
+        Return the encoded snapshot of the current version.
+        """
+
+        if self._snapshot is None:
+            self._snapshot = '%s,%s,%d,%s' % (SNAPSHOT, self.name, self.seq,
+                                              _dumps(self.document))
+        return self._snapshot
+
+
+class StateSync(object):
+    """
+    Document kept in sync with the client of a single connection::
+
+        sync = StateSync(request.websocket, 'dashboard')
+        while True:
+            sync.send(build_dashboard(request.user))
+            ...
+    """
+
+    def __init__(self, websocket, name):
+        self.websocket = websocket
+        self.state     = StateDocument(name)
+
+    def send(self, document):
+        """
+        Send the changes of document since the last version sent.
+        """
+
+        message = self.state.update(document)
+        if message is not None:
+            self.websocket.send(message, priority=PRIORITY_INTERACTIVE)
+
+    def resync(self):
+        """
+        Send the full snapshot again, e.g. when the client saw a gap.
+        """
+
+        if self.state.seq:
+            self.websocket.send(self.state.snapshot(), priority=PRIORITY_INTERACTIVE)
+
+
+class StateChannels(object):
+    """
+    Named documents shared by the connections subscribed to them.
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def state(self, channel):
+        """
+        Return the document state of channel.
+        """
+
+        state = self._states.get(channel)
+        if state is None:
+            state = self._states[channel] = StateDocument(channel)
+        return state
+
+    def publish(self, channel, document):
+        """
+        Make document the current version of channel and send its changes
+        to the subscribers. Returns the number of connections it was sent
+        to.
+        """
+
+        message = self.state(channel).update(document)
+        if message is None:
+            return 0
+        return registry.send(message, tag=_channel_tag(channel), priority=PRIORITY_INTERACTIVE)
+
+    def subscribe(self, websocket, channel):
+        """
+        Subscribe websocket to channel, sending the current snapshot first.
+        """
+
+        state = self.state(channel)
+        # tagged before sending, a publish while the snapshot is written
+        # follows it
+        registry.tag(websocket, _channel_tag(channel))
+        if state.seq:
+            websocket.send(state.snapshot(), priority=PRIORITY_INTERACTIVE)
+
+    def resync(self, websocket, channel):
+        """
+        Send the current snapshot of channel again.
+        """
+
+        state = self.state(channel)
+        if state.seq:
+            websocket.send(state.snapshot(), priority=PRIORITY_INTERACTIVE)
+
+    def unsubscribe(self, websocket, channel):
+        """
+        Stop sending changes of channel to websocket.
+        """
+
+        registry.untag(websocket, _channel_tag(channel))
+
+    def discard(self, channel):
+        """
+        Forget the document of channel.
+        """
+
+        self._states.pop(channel, None)
+
+
+def _channel_tag(channel):
+    return ('djangosocket.statesync', channel)
+
+
+states = StateChannels()
@@ -2,10 +2,19 @@
 
 import logging
 import collections
+import time
 
+import eventlet
+from eventlet import event
 from eventlet import semaphore
 
+from djangosocket import capture
+from djangosocket import trace
+from djangosocket.conf import settings
+from djangosocket.registry import registry
 from djangosocket.stream import const
+from djangosocket.stream import outbound
+from djangosocket.stream import ratelimit
 
 
 class ConnectionTerminatedException(Exception):
@@ -111,20 +120,77 @@ class StreamBase(object):
     
     _socket_recv_bytes = 4096
     
-    def __init__(self, socket):
+    def __init__(self, socket, request=None):
         """
         Construct an instance.
 
         socket: django request websocket object.
+        request: django request.
         """
 
         self._logger            = logging.getLogger('djangosocket.stream')
         self._socket            = socket
+        self._request           = request
         self._buffer            = ""
+        self._receiving         = None
+        self._recv_waiting      = 0
+        self._recv_time         = None
         self._message_queue     = collections.deque()
         self._sendlock          = semaphore.Semaphore()
+        self._outbound          = outbound.OutboundScheduler()
+        self._writer            = None
+        self._ratelimit         = ratelimit.for_connection(self._client_address())
+        self.db_guard           = None
+        self._dispatched        = None
+        self._capture           = None
+        self._close_deadline    = None
+        self.close_acknowledged = False
         self.closed             = False
     
+    def _get_closed(self):
+        return self._closed
+    
+    def _set_closed(self, value):
+        self._closed = value
+        if value:
+            # closed connections must not be reachable from the registry
+            registry.unregister(self)
+            if self._ratelimit is not None:
+                self._ratelimit.release()
+            if self._capture is not None:
+                self._capture.close()
+                self._capture = None
+    
+    closed = property(_get_closed, _set_closed)
+    
+    @property
+    def rtt(self):
+        """
+        Smoothed round-trip time to the client in seconds, None when it
+        is not measured.
+        """
+        
+        return None
+    
+    @property
+    def rtt_variance(self):
+        """
+        Mean deviation of the round-trip time in seconds, None when it is
+        not measured.
+        """
+        
+        return None
+    
+    def _client_address(self):
+        """
+        Return the client IP, or None if it cannot be determined.
+        """
+        
+        try:
+            peer = self._socket.getpeername()[0]
+        except Exception:
+            peer = None
+        return ratelimit.client_address(self._request, peer)
     
     def _send_handshake(self):
         """
@@ -133,9 +199,16 @@ class StreamBase(object):
         
         raise NotImplementedError()
     
-    def send(self):
+    def send(self, message, key=None, ttl=None, priority=None):
         """
         Send a message to the client.
+        
+        key: a newer message sent with the same key replaces this one while
+        it is waiting in the outbound queue.
+        ttl: number of seconds after which the message is dropped unsent.
+        priority: outbound.PRIORITY_INTERACTIVE or outbound.PRIORITY_BULK,
+        interactive by default. Messages larger than
+        DJANGOSOCKET_OUTBOUND_BULK_THRESHOLD, when set, are sent as bulk.
         """
         
         raise NotImplementedError()
@@ -145,8 +218,37 @@ class StreamBase(object):
         Perform WebSocket Handshake.
         """
 
+        if settings.DJANGOSOCKET_TRACE_HUB_BLOCK_MS:
+            trace.watchdog(settings.DJANGOSOCKET_TRACE_HUB_BLOCK_MS / 1000.0)
+        start = time.time()
         self._send_handshake()
         self._logger.debug('Sent opening handshake response')
+        trace.handshakes.add(time.time() - start)
+        if trace.enabled:
+            trace.emit(trace.EVENT_HANDSHAKE, self, start)
+        if not self.closed:
+            registry.register(self, self._request)
+            if self._request is not None:
+                self._capture = capture.session(self._request)
+    
+    def _send_closing_handshake(self, code=None, reason=''):
+        """
+        Send closing handshake to the client.
+        """
+        
+        raise NotImplementedError()
+    
+    def drain_close(self, code, reason='', deadline=None):
+        """
+        Start the closing handshake with status code and reason. The reader
+        waits for the client to acknowledge it until the deadline timestamp
+        before giving up on the connection.
+        """
+        
+        if self.closed:
+            return
+        self._close_deadline = deadline
+        self._send_closing_handshake(code, reason)
     
     def _write(self, bytes):
         """
@@ -154,6 +256,7 @@ class StreamBase(object):
         """
         
         self._sendlock.acquire()
+        start = trace.enabled and time.time()
         try:
             self._socket.sendall(bytes)
         except:
@@ -161,6 +264,89 @@ class StreamBase(object):
             self.closed = True
         finally:
             self._sendlock.release()
+        if start:
+            trace.emit(trace.EVENT_WRITE, self, start, bytes=len(bytes))
+    
+    def _write_handshake(self, bytes):
+        """
+        Writes the handshake response. Nothing else can be writing yet, the
+        send lock is not needed.
+        """
+        
+        try:
+            self._socket.sendall(bytes)
+        except:
+            self.closed = True
+    
+    def _priority(self, message, priority):
+        """
+        Return the priority class of message.
+        """
+        
+        if priority is not None:
+            return priority
+        threshold = settings.DJANGOSOCKET_OUTBOUND_BULK_THRESHOLD
+        if threshold and len(message) > threshold:
+            return outbound.PRIORITY_BULK
+        return outbound.PRIORITY_INTERACTIVE
+    
+    def _queue_frame(self, frame, key=None, ttl=None, priority=outbound.PRIORITY_INTERACTIVE,
+                     done=None):
+        """
+        Writes given frame, or iterator of fragments, to connection. Unless
+        it can be written right away, the frame goes through the outbound
+        scheduler which is flushed by a writer greenthread. done is called
+        with True once the frame is written, False if it is dropped.
+        
+        Senders of frames without a key then wait until their frame is
+        written, as do senders of keyed frames once
+        DJANGOSOCKET_OUTBOUND_MAX_QUEUE frames are pending (or until the
+        frame is replaced), so that a slow client pushes back instead of
+        growing the queue. Control frames never wait.
+        """
+        
+        if self._writer is None and key is None and ttl is None and \
+            priority != outbound.PRIORITY_BULK:
+            self._write(frame)
+            if done is not None:
+                done(True)
+            return
+        sent = None
+        if priority != outbound.PRIORITY_CONTROL and \
+            (key is None or len(self._outbound) >= settings.DJANGOSOCKET_OUTBOUND_MAX_QUEUE):
+            # wait for this frame only, not for frames queued after it
+            sent = event.Event()
+            notify = done
+            def done(written):
+                if notify is not None:
+                    notify(written)
+                sent.send()
+        self._outbound.put(frame, priority, key, ttl, done)
+        if self._writer is None:
+            self._writer = eventlet.spawn(self._flush_outbound)
+        if sent is not None:
+            sent.wait()
+    
+    def _flush_outbound(self):
+        """
+        Writes queued frames by priority until the outbound scheduler is
+        empty. Only control frames are written once the connection is closed.
+        """
+        
+        try:
+            while True:
+                frame, priority, done = self._outbound.get()
+                if frame is None:
+                    break
+                if self.closed and priority != outbound.PRIORITY_CONTROL:
+                    if done is not None:
+                        done(False)
+                    continue
+                self._write(frame)
+                if done is not None:
+                    done(True)
+        finally:
+            self._writer = None
     
     
     def _parse_message_queue(self):
@@ -178,38 +364,219 @@ class StreamBase(object):
         raise NotImplementedError()
     
     
-    def _socket_recv(self):
+    def _recv(self, timeout=None):
+        """
+        Reads from the socket, waiting up to timeout seconds. Returns None
+        on timeout. Other greenthreads wait for the read to complete with
+        _await_read rather than reading concurrently.
+        """
+        
+        self._receiving = event.Event()
+        delta = None
+        try:
+            with eventlet.Timeout(timeout, False):
+                delta = self._socket.recv(self._socket_recv_bytes)
+        finally:
+            receiving, self._receiving = self._receiving, None
+            receiving.send()
+        if delta:
+            self._recv_time = time.time()
+        return delta
+    
+    def _await_read(self, timeout=None):
+        """
+        Waits up to timeout seconds for the greenthread reading the socket
+        to be done, what it read being parsed into the message queue.
+        Returns None on timeout.
+        """
+        
+        receiving = self._receiving
+        if receiving is None:
+            return True
+        self._recv_waiting += 1
+        try:
+            with eventlet.Timeout(timeout, False):
+                receiving.wait()
+                return True
+        finally:
+            self._recv_waiting -= 1
+        return None
+    
+    def _socket_recv(self, timeout=None):
         """
-        Gets new data from the socket and try to parse new messages.
+        Gets new data from the socket and try to parse new messages. Returns
+        None if no data arrived within timeout seconds.
         """
         
-        delta = self._socket.recv(self._socket_recv_bytes)
+        if self._ratelimit is not None:
+            throttled = self._throttle(timeout)
+            if throttled is not True:
+                return throttled
+        if self._receiving is not None:
+            # the pinger is reading, its messages get queued for us
+            return self._await_read(timeout)
+        
+        start = trace.enabled and time.time()
+        delta = self._recv(timeout)
+        if delta is None:
+            return None
+        if start:
+            trace.emit(trace.EVENT_RECV, self, start, bytes=len(delta))
         if delta == '':
             return False
         self._buffer += delta
         
+        start = trace.enabled and time.time()
         msgs = self._parse_message_queue()
+        if start:
+            trace.emit(trace.EVENT_PARSE, self, start, messages=len(msgs))
+        if self._ratelimit is not None:
+            self._ratelimit.charge(len(msgs), len(delta))
         
         self._message_queue.extend(msgs)
         return True
     
+    def _throttle(self, timeout=None):
+        """
+        Stop reading from the socket while the client is over its rate
+        limits, leaving its data in the kernel buffers. Returns False if
+        the connection got closed by the over-limit policy, None if it
+        would have to wait longer than timeout seconds.
+        """
+        
+        delay = self._ratelimit.delay()
+        if not delay:
+            return True
+        if self._ratelimit.policy == ratelimit.POLICY_CLOSE:
+            self._logger.debug('Closing connection over its rate limits')
+            self._send_closing_handshake()
+            return False
+        if timeout is not None and delay > timeout:
+            return None
+        eventlet.sleep(delay)
+        return not self.closed
+    
     
-    def _wait(self):
+    def _fill(self, deadline=None):
         """
-        Waits for and deserializes messages. Returns a single message; the
-        oldest not yet processed.
+        Waits until at least one message is queued. Returns False if the
+        deadline timestamp passed first.
         """
         
         while not self._message_queue:
             # Websocket might be closed already.
             if self.closed:
+                if self._close_deadline is not None:
+                    self._await_close_ack()
                 raise ConnectionTerminatedException('Receiving byte failed. Peer closed connection')
-            # no parsed messages, must mean buf needs more data
-            bytes = self._socket_recv()
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            guard = self.db_guard
+            if guard is not None and guard.used and \
+                (timeout is None or timeout > guard.release_after):
+                # close database connections once the view has been waiting
+                # for a while, bursts of messages keep using them
+                bytes = self._socket_recv(guard.release_after)
+                if bytes is None:
+                    guard.idle()
+                    continue
+            else:
+                # no parsed messages, must mean buf needs more data
+                bytes = self._socket_recv(timeout)
+            if bytes is None:
+                return False
             if not bytes:
+                self.closed = True
                 raise ConnectionTerminatedException('Receiving byte failed. Peer closed connection')
+        return True
+    
+    def _dispatch_done(self):
+        """
+        Called when the view comes back for more messages.
+        """
+        
+        if self._dispatched is not None:
+            # the view is done with the previous messages
+            trace.emit(trace.EVENT_DISPATCH, self, self._dispatched)
+            self._dispatched = None
+    
+    def _dispatch_start(self):
+        """
+        Called before messages are handed to the view.
+        """
+        
+        if self.db_guard is not None:
+            self.db_guard.busy()
+        if trace.enabled:
+            trace.active = self
+            self._dispatched = time.time()
+    
+    def _wait(self):
+        """
+        Waits for and deserializes messages. Returns a single message; the
+        oldest not yet processed.
+        """
+        
+        self._dispatch_done()
+        self._fill()
+        self._dispatch_start()
         return self._message_queue.popleft()
     
+    def receive_many(self, max_count=None, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for messages and
+        returns every queued message at once, at most max_count. Returns
+        an empty list if none arrived in time.
+        
+        Raises ConnectionTerminatedException once the connection is closed
+        and every message has been received.
+        """
+        
+        self._dispatch_done()
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if not self._fill(deadline):
+            return []
+        self._dispatch_start()
+        
+        queue = self._message_queue
+        if max_count is None or max_count >= len(queue):
+            messages = list(queue)
+            queue.clear()
+        else:
+            messages = [queue.popleft() for i in xrange(max_count)]
+        return messages
+    
+    def poll(self, max_count=None):
+        """
+        Returns every message received so far, at most max_count, reading
+        data already available on the socket without waiting for more.
+        """
+        
+        return self.receive_many(max_count, 0)
+    
+    
+    def _await_close_ack(self):
+        """
+        Read until the client acknowledges the closing handshake, the
+        connection drops or the close deadline is reached.
+        """
+        
+        while not self.close_acknowledged:
+            remaining = self._close_deadline - time.time()
+            if remaining <= 0:
+                return
+            if self._receiving is not None:
+                self._await_read(remaining)
+                continue
+            delta = self._recv(remaining)
+            if not delta:
+                return
+            self._buffer += delta
+            self._parse_message_queue()
+    
     
     def __iter__(self):
         """
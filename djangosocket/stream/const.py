@@ -52,4 +52,14 @@ SEC_WEBSOCKET_EXTENSIONS_HEADER = 'Sec-WebSocket-Extensions'
 SEC_WEBSOCKET_DRAFT_HEADER = 'Sec-WebSocket-Draft'
 SEC_WEBSOCKET_KEY1_HEADER = 'Sec-WebSocket-Key1'
 SEC_WEBSOCKET_KEY2_HEADER = 'Sec-WebSocket-Key2'
-SEC_WEBSOCKET_LOCATION_HEADER = 'Sec-WebSocket-Location'
\ No newline at end of file
+SEC_WEBSOCKET_LOCATION_HEADER = 'Sec-WebSocket-Location'
+
+# Status codes of closing frames.
+STATUS_NORMAL_CLOSURE = 1000
+STATUS_GOING_AWAY = 1001
+STATUS_PROTOCOL_ERROR = 1002
+STATUS_INVALID_FRAME_PAYLOAD_DATA = 1007
+STATUS_SERVICE_RESTART = 1012
+
+# Subprotocol multiplexing logical channels over a single connection.
+MUX_PROTOCOL = 'djangosocket-mux'
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -
+
+"""
+Opening handshake responses.
+
+Responses are rendered from templates built once per protocol and
+locations are cached by host and path, so that a reconnect storm costs
+little more than the challenge of each client.
+"""
+
+import string
+import struct
+
+from djangosocket.stream import const
+from djangosocket.stream.base import HandshakeException
+from djangosocket.stream.base import build_location
+
+__all__ = ('hybi_response', 'hixie76_response', 'hixie76_key', 'hixie76_challenge_key',
+           'location')
+
+LOCATION_CACHE_SIZE = 1024
+
+
+def _header(name, value='%s'):
+    return '%s: %s\r\n' % (name, value)
+
+_HYBI = ''.join([
+    'HTTP/1.1 101 Switching Protocols\r\n',
+    _header(const.UPGRADE_HEADER, const.WEBSOCKET_UPGRADE_TYPE),
+    _header(const.CONNECTION_HEADER, const.UPGRADE_CONNECTION_TYPE),
+    _header(const.SEC_WEBSOCKET_ORIGIN_HEADER),
+])
+_HYBI_ACCEPT = _HYBI + _header(const.SEC_WEBSOCKET_ACCEPT_HEADER) + '\r\n'
+_HYBI_PROTOCOL_ACCEPT = _HYBI + _header(const.SEC_WEBSOCKET_PROTOCOL_HEADER) + \
+    _header(const.SEC_WEBSOCKET_ACCEPT_HEADER) + '\r\n'
+
+_HIXIE76 = ''.join([
+    'HTTP/1.1 101 Web Socket Protocol Handshake\r\n',
+    _header(const.UPGRADE_HEADER, const.WEBSOCKET_UPGRADE_TYPE_HIXIE76),
+    _header(const.CONNECTION_HEADER, const.UPGRADE_CONNECTION_TYPE),
+    _header(const.SEC_WEBSOCKET_ORIGIN_HEADER),
+    _header(const.SEC_WEBSOCKET_LOCATION_HEADER),
+    _header(const.SEC_WEBSOCKET_PROTOCOL_HEADER),
+    '\r\n',
+])
+
+# every byte but digits, deleted from hixie76 keys in a single pass
+_NON_DIGITS = ''.join([chr(i) for i in xrange(256) if chr(i) not in string.digits])
+
+_locations = {}
+
+
+def hybi_response(origin, accept, protocol=''):
+    """
+    Return the hybi handshake response.
+    """
+
+    if protocol:
+        return str(_HYBI_PROTOCOL_ACCEPT % (origin, protocol, accept))
+    return str(_HYBI_ACCEPT % (origin, accept))
+
+
+def hixie76_response(origin, location, protocol, challenge):
+    """
+    Return the hixie76 handshake response followed by the challenge answer.
+    """
+
+    return str(_HIXIE76 % (origin, location, protocol)) + challenge
+
+
+def hixie76_key(value):
+    """
+    Return the number encoded in a Sec-WebSocket-Key1/2 header: its digits
+    divided by its number of spaces, e.g. 4926105 for 'g98sd  5[]221@1'.
+    """
+
+    if value is None:
+        raise HandshakeException('Missing hixie76 key')
+    value = str(value)
+    spaces = value.count(' ')
+    digits = value.translate(None, _NON_DIGITS)
+    if not spaces or not digits:
+        raise HandshakeException('Malformed hixie76 key: %r' % value)
+    return int(digits) / spaces
+
+
+def hixie76_challenge_key(key1, key2):
+    """
+    Return the packed numbers of both hixie76 keys.
+    """
+
+    return struct.pack('>II', hixie76_key(key1), hixie76_key(key2))
+
+
+def location(request):
+    """
+    Return the websocket location of request, cached by scheme, host and
+    path.
+    """
+
+    meta = request.META
+    key = (request.is_secure(), meta.get('HTTP_X_FORWARDED_HOST'), meta.get('HTTP_HOST'),
+           request.path)
+    result = _locations.get(key)
+    if result is None:
+        if len(_locations) >= LOCATION_CACHE_SIZE:
+            _locations.clear()
+        result = _locations[key] = build_location(request)
+    return result
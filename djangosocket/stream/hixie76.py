@@ -6,21 +6,22 @@ WebSocket protocol with the framing used by Hixie 76 protocol.
 
 import re
 import logging
-import struct
-import string
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
+from djangosocket import capture
 from djangosocket.stream import const
+from djangosocket.stream import handshake
+from djangosocket.stream import outbound
+from djangosocket.stream import utf8
 from djangosocket.stream.base import BadOperationException
 from djangosocket.stream.base import ConnectionTerminatedException
 from djangosocket.stream.base import InvalidFrameException
 from djangosocket.stream.base import UnsupportedFrameException
 from djangosocket.stream.base import StreamBase
 from djangosocket.stream.base import HandshakeException
-from djangosocket.stream.base import build_location
 
 
 class WebSocket(StreamBase):
@@ -35,12 +36,11 @@ class WebSocket(StreamBase):
         request: django request.
         socket: django request websocket object.
         """
-        super(WebSocket, self).__init__(socket)
+        super(WebSocket, self).__init__(socket, request)
         
         self._logger = logging.getLogger('djangosocket.websocket')
-        self._request = request
         self._origin = request.META.get('HTTP_ORIGIN', '')
-        self._location = build_location(request)
+        self._location = handshake.location(request)
         self._protocol = request.META.get('HTTP_SEC_WEBSOCKET_PROTOCOL', 'default')
         self._version = const.VERSION_HIXIE76
     
@@ -49,54 +49,38 @@ class WebSocket(StreamBase):
         Generate hash value for WebSockets hixie-76.
         """
         
-        def _get_key_value(value):
-            """
-            Utility function which, given a string like 'g98sd  5[]221@1', will
-            return 9852211. Used to parse the Sec-WebSocket-Key headers.
-            """
-            out = ""
-            spaces = 0
-            for char in value:
-                if char in string.digits:
-                    out += char
-                elif char == " ":
-                    spaces += 1
-            return int(out) / spaces
-        
         key1 = self._request.META.get('HTTP_SEC_WEBSOCKET_KEY1', None)
         key2 = self._request.META.get('HTTP_SEC_WEBSOCKET_KEY2', None)
         key3 = self._request.META['wsgi.input'].read()
         
-        return md5(struct.pack(">II", _get_key_value(key1), _get_key_value(key2)) + key3).digest()
+        return md5(handshake.hixie76_challenge_key(key1, key2) + key3).digest()
     
     def _send_handshake(self):
-        
-        handshake_parts = []
-        handshake_parts.append('HTTP/1.1 101 Web Socket Protocol Handshake\r\n')
-        handshake_parts.append('%s: %s\r\n' %(const.UPGRADE_HEADER, const.WEBSOCKET_UPGRADE_TYPE_HIXIE76))
-        handshake_parts.append('%s: %s\r\n' % (const.CONNECTION_HEADER, const.UPGRADE_CONNECTION_TYPE))
-        handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_ORIGIN_HEADER, self._origin))
-        handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_LOCATION_HEADER, self._location))
-        handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_PROTOCOL_HEADER, self._protocol))
-        handshake_parts.append('\r\n')
-        handshake_reply = str(''.join(handshake_parts)) + self.gen_challenge()
-        
-        self._write(handshake_reply)
+        self._write_handshake(handshake.hixie76_response(self._origin, self._location,
+                                                         self._protocol, self.gen_challenge()))
     
-    def _send_closing_handshake(self):
+    def _send_closing_handshake(self, code=None, reason=''):
+        # hixie76 closing handshake has no status code nor reason
+        if self._capture is not None:
+            # recorded before the capture session ends with the connection
+            self._capture.record(capture.OUTBOUND, 0x08)
         self.closed = True
 
         # 5.3 the server may decide to terminate the WebSocket connection by
         # running through the following steps:
         # 1. send a 0xFF byte and a 0x00 byte to the client to indicate the
         # start of the closing handshake.
-        self._write('\xff\x00')
+        self._queue_frame('\xff\x00', priority=outbound.PRIORITY_CONTROL)
     
-    def send(self, message):
+    def send(self, message, key=None, ttl=None, priority=None):
         """
         Send message.
 
         message: unicode string to send.
+        key: conflation key, a newer message with the same key replaces
+        this one while it is waiting in the outbound queue.
+        ttl: number of seconds after which the message is dropped unsent.
+        priority: outbound priority class.
 
         Raises BadOperationException when called on a server-terminated
         connection.
@@ -110,7 +94,10 @@ class WebSocket(StreamBase):
         elif not isinstance(message, str): # Message for binary frame must be instance of str
             message = str(message)
 
-        self._write(''.join(['\x00', message, '\xff']))
+        if self._capture is not None:
+            self._capture.record(capture.OUTBOUND, 0x01, message)
+        self._queue_frame(''.join(['\x00', message, '\xff']), key, ttl,
+                          self._priority(message, priority))
 
     def _parse_message_queue(self):
         """
@@ -122,11 +109,6 @@ class WebSocket(StreamBase):
         didn't contain any full messages.
         """
 
-        if self.closed:
-            raise BadOperationException(
-                'Requested receive_message after receiving a closing '
-                'handshake')
-
         msgs = []
         end_idx = 0
         buf = self._buffer
@@ -137,14 +119,33 @@ class WebSocket(StreamBase):
                 end_idx = buf.find("\xFF")
                 if end_idx == -1: #pragma NO COVER
                     break
-                msgs.append(buf[1:end_idx].decode('utf-8', 'replace'))
+                if self.closed:
+                    # sent by the client before it got our closing handshake
+                    buf = buf[end_idx+1:]
+                    continue
+                if self._capture is not None:
+                    self._capture.record(capture.INBOUND, 0x01, buf[1:end_idx])
+                try:
+                    msgs.append(utf8.decode(buf[1:end_idx]))
+                except UnicodeDecodeError:
+                    self._logger.debug('Closing connection: message is not valid UTF-8')
+                    self._send_closing_handshake()
+                    buf = ''
+                    break
                 buf = buf[end_idx+1:]
             elif frame_type == 255:
                 # Closing handshake.
                 assert ord(buf[1]) == 0, "Unexpected closing handshake: %r" % buf
-                self._logger.debug('Received client-initiated closing handshake')
-                self._send_closing_handshake()
-                self._logger.debug('Sent ack for client-initiated closing handshake')
+                if self._capture is not None:
+                    self._capture.record(capture.INBOUND, 0x08)
+                if self.closed:
+                    self._logger.debug('Received ack for server-initiated closing handshake')
+                    self.close_acknowledged = True
+                else:
+                    self._logger.debug('Received client-initiated closing handshake')
+                    self._send_closing_handshake()
+                    self._logger.debug('Sent ack for client-initiated closing handshake')
+                buf = ''
                 break
             else:
                 raise ValueError("Don't understand how to parse this type of message: %r" % buf)
@@ -8,28 +8,51 @@ import re
 import logging
 import struct
 import string
+import time
 from base64 import b64encode, b64decode
 import array
 
-try:
-    import numpy
-except:
-    pass
-
 try:
     from hashlib import sha1
 except:
     from sha import sha as sha1
 
+import eventlet
+
+from djangosocket import capture
+from djangosocket.conf import settings
 from djangosocket.stream import const
+from djangosocket.stream import handshake
+from djangosocket.stream import outbound
+from djangosocket.stream.rtt import RttEstimator
+from djangosocket.stream.utf8 import Utf8Validator
 from djangosocket.stream.base import BadOperationException
 from djangosocket.stream.base import ConnectionTerminatedException
 from djangosocket.stream.base import InvalidFrameException
+from djangosocket.stream.base import InvalidUTF8Exception
 from djangosocket.stream.base import UnsupportedFrameException
 from djangosocket.stream.base import UnsupportedProtocolException
 from djangosocket.stream.base import StreamBase
 from djangosocket.stream.base import HandshakeException
-from djangosocket.stream.base import build_location
+
+# numpy module, imported on first unmask, False if it isn't available
+_numpy = None
+
+# messages and bytes the pinger reads ahead of the view while waiting for a
+# pong, beyond which the client's data is left in the kernel buffers
+PONG_READ_AHEAD = 16
+PONG_READ_AHEAD_BYTES = 65536
+
+
+def _load_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
 
 
 class WebSocket(StreamBase):
@@ -44,15 +67,19 @@ class WebSocket(StreamBase):
         request: django request.
         socket: django request websocket object.
         """
-        super(WebSocket, self).__init__(socket)
+        super(WebSocket, self).__init__(socket, request)
 
         self._logger = logging.getLogger('djangosocket.websocket')
-        self._request = request
         self._origin = request.META.get('HTTP_ORIGIN', '')
-        self._location = build_location(request)
         self._protocol = request.META.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '')
         self._version = const.VERSION_HYBI_LATEST
         self.recv_part = ''
+        self._received = None
+        self._validator = None
+        self._rtt = RttEstimator()
+        self._ping_seq = 0
+        self._ping_payload = None
+        self._ping_sent = None
 
         protocols = self._protocol.split(',')
         if 'binary' in protocols:
@@ -71,31 +98,106 @@ class WebSocket(StreamBase):
         challenge.update(key + const.WEBSOCKET_ACCEPT_UUID)
         return b64encode(challenge.digest())
 
-    def _send_handshake(self):
+    @property
+    def rtt(self):
+        """
+        Smoothed round-trip time to the client in seconds, None until a
+        ping got answered.
+        """
+
+        return self._rtt.srtt
+
+    @property
+    def rtt_variance(self):
+        """
+        Mean deviation of the round-trip time in seconds.
+        """
+
+        return self._rtt.rttvar
+
+    def do_handshake(self):
+        super(WebSocket, self).do_handshake()
+        interval = settings.DJANGOSOCKET_PING_INTERVAL
+        if interval and not self.closed:
+            eventlet.spawn_after(interval, self._keep_pinging, interval)
+
+    def _keep_pinging(self, interval):
+        while not self.closed:
+            deadline = time.time() + interval
+            self.ping()
+            self._read_pong(deadline)
+            eventlet.sleep(max(deadline - time.time(), 0))
+
+    def _read_pong(self, deadline):
+        """
+        Reads the socket until the last ping got answered or the deadline
+        passes, whenever the view isn't reading, so that the pong is timed
+        when it arrives rather than when the view next receives. Messages
+        read meanwhile are queued for the view, up to PONG_READ_AHEAD
+        messages and within the rate limits of the client.
+        """
+
+        while self._ping_sent is not None and not self.closed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if self._receiving is not None:
+                self._await_read(remaining)
+            elif self._recv_waiting:
+                # let the view waiting for our last read take over
+                eventlet.sleep(0)
+            elif len(self._message_queue) >= PONG_READ_AHEAD or \
+                len(self._buffer) >= PONG_READ_AHEAD_BYTES or \
+                (self._ratelimit is not None and self._ratelimit.delay()):
+                # the view is behind or the client over its limits, the
+                # pong waits in the kernel buffers with the rest
+                return
+            else:
+                received = self._socket_recv(remaining)
+                if received is None:
+                    return
+                if received is False:
+                    self.closed = True
+
+    def ping(self):
+        """
+        Send a ping whose pong updates the round-trip time estimate. A ping
+        still unanswered is superseded.
+        """
+
+        if self.closed:
+            return
+        self._ping_seq = (self._ping_seq + 1) & 0xffffffff
+        self._ping_payload = struct.pack('>I', self._ping_seq)
+        if self._capture is not None:
+            self._capture.record(capture.OUTBOUND, 0x09, self._ping_payload)
+        buf, h, t = self.encode_hybi(self._ping_payload, opcode=0x09)
+        self._ping_sent = time.time()
+        self._queue_frame(buf, priority=outbound.PRIORITY_CONTROL)
 
-        handshake_parts = []
-        handshake_parts.append('HTTP/1.1 101 Switching Protocols\r\n')
-        handshake_parts.append('%s: %s\r\n' %(const.UPGRADE_HEADER, const.WEBSOCKET_UPGRADE_TYPE))
-        handshake_parts.append('%s: %s\r\n' % (const.CONNECTION_HEADER, const.UPGRADE_CONNECTION_TYPE))
-        handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_ORIGIN_HEADER, self._origin))
-        handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_LOCATION_HEADER, self._location))
-        if self._protocol:
-            handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_PROTOCOL_HEADER, self._protocol))
-        handshake_parts.append('%s: %s\r\n' % (const.SEC_WEBSOCKET_ACCEPT_HEADER, self.gen_challenge()))
-        handshake_parts.append('\r\n')
-        handshake_reply = str(''.join(handshake_parts))
-
-        self._write(handshake_reply)
-
-    def _send_closing_handshake(self):
+    def _send_handshake(self):
+        self._write_handshake(handshake.hybi_response(self._origin, self.gen_challenge(),
+                                                      self._protocol))
+
+    def _send_closing_handshake(self, code=None, reason=''):
+        payload = code is not None and struct.pack('>H', code) + reason or ''
+        if self._capture is not None:
+            # recorded before the capture session ends with the connection
+            self._capture.record(capture.OUTBOUND, 0x08, payload)
         self.closed = True
 
         # 5.3 the server may decide to terminate the WebSocket connection by
         # running through the following steps:
         # 1. send a 0xFF byte and a 0x00 byte to the client to indicate the
         # start of the closing handshake.
-        buf, h, t = self.encode_hybi('', opcode=0x08)
-        self._write(buf)
+        buf, h, t = self.encode_hybi(payload, opcode=0x08)
+        self._queue_frame(buf, priority=outbound.PRIORITY_CONTROL)
+
+    def _send_pong(self, payload):
+        if self._capture is not None:
+            self._capture.record(capture.OUTBOUND, 0x0A, payload)
+        buf, h, t = self.encode_hybi(payload, opcode=0x0A)
+        self._queue_frame(buf, priority=outbound.PRIORITY_CONTROL)
 
     @staticmethod
     def unmask(buf, f):
@@ -105,6 +207,7 @@ class WebSocket(StreamBase):
         pstart = f['hlen'] + 4
         pend = pstart + f['length']
 
+        numpy = _load_numpy()
         if numpy:
             b = c = s2b('')
             if f['length'] >= 4:
@@ -132,9 +235,10 @@ class WebSocket(StreamBase):
             return data.tostring()
 
     @staticmethod
-    def encode_hybi(buf, opcode):
+    def encode_hybi(buf, opcode, fin=True):
         """
-        Encode a HyBi style WebSocket frame.
+        Encode a HyBi style WebSocket frame, the last fragment of a message
+        unless fin is False.
         Optional opcode:
             0x0 - continuation
             0x1 - text frame (base64 encode buf)
@@ -144,7 +248,7 @@ class WebSocket(StreamBase):
             0xA - pong
         """
 
-        b1 = 0x80 | (opcode & 0x0f) # FIN + opcode
+        b1 = (fin and 0x80 or 0) | (opcode & 0x0f) # FIN + opcode
         payload_len = len(buf)
         if payload_len <= 125:
             header = struct.pack('>BB', b1, payload_len)
@@ -225,17 +329,32 @@ class WebSocket(StreamBase):
 
         if f['opcode'] == 0x08:
             if f['length'] >= 2:
-                f['close_code'] = struct.unpack_from(">H", f['payload'])
+                (f['close_code'],) = struct.unpack_from(">H", f['payload'])
             if f['length'] > 3:
                 f['close_reason'] = f['payload'][2:]
 
         return f
 
-    def send(self, message):
+    def _fragments(self, message, opcode, size):
+        """
+        Generate the frames of message fragmented in payloads of size bytes.
+        """
+
+        for start in xrange(0, len(message), size):
+            fin = start + size >= len(message)
+            yield self.encode_hybi(message[start:start + size], opcode, fin)[0]
+            opcode = 0x00
+
+    def send(self, message, key=None, ttl=None, priority=None):
         """
         Send message.
 
         message: unicode string to send.
+        key: conflation key, a newer message with the same key replaces
+        this one while it is waiting in the outbound queue.
+        ttl: number of seconds after which the message is dropped unsent.
+        priority: outbound priority class, bulk messages are fragmented so
+        that control frames can be sent between fragments.
 
         Raises BadOperationException when called on a server-terminated
         connection.
@@ -244,13 +363,60 @@ class WebSocket(StreamBase):
         if self.closed:
             raise BadOperationException(
                 'Requested send after sending out a closing handshake')
+        self._send_message(message, key, ttl, priority)
+
+    def _send_message(self, message, key=None, ttl=None, priority=None, done=None):
+        """
+        Encode and queue message, done being called once it is written or
+        dropped.
+        """
+
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
 
-        if self.base64:
-            encbuf, lenhead, lentail = self.encode_hybi(message, opcode=1)
+        opcode = self.base64 and 1 or 2
+        if self._capture is not None:
+            self._capture.record(capture.OUTBOUND, opcode, message)
+        priority = self._priority(message, priority)
+        size = settings.DJANGOSOCKET_OUTBOUND_FRAGMENT_SIZE
+        if priority == outbound.PRIORITY_BULK and len(message) > size:
+            encbuf = self._fragments(message, opcode, size)
         else:
-            encbuf, lenhead, lentail = self.encode_hybi(message, opcode=2)
+            encbuf, lenhead, lentail = self.encode_hybi(message, opcode=opcode)
+
+        self._queue_frame(encbuf, key, ttl, priority, done)
+
+    def _reassemble(self, frame):
+        """
+        Add a data frame to the message being received and return the
+        message once its last fragment arrived, None until then. Text
+        messages are validated fragment by fragment so that invalid UTF-8
+        is detected before the rest of the message is buffered.
+        """
 
-        self._write(encbuf)
+        if frame['opcode'] == 0x0:
+            if self._received is None:
+                raise InvalidFrameException('Continuation frame outside of a message')
+        elif self._received is not None:
+            raise InvalidFrameException('New message before the end of the previous one')
+        else:
+            self._received = []
+            self._validator = frame['opcode'] == 0x1 and Utf8Validator() or None
+
+        payload = frame['payload']
+        if self._validator is not None and not self._validator.feed(payload, frame['fin']):
+            raise InvalidUTF8Exception('Text message is not valid UTF-8')
+        if frame['fin'] and not self._received:
+            # unfragmented message
+            self._received = None
+            return payload
+
+        self._received.append(payload)
+        if not frame['fin']:
+            return None
+        message = ''.join(self._received)
+        self._received = None
+        return message
 
     def _parse_message_queue(self):
         """
@@ -262,11 +428,6 @@ class WebSocket(StreamBase):
         didn't contain any full messages.
         """
 
-        if self.closed:
-            raise BadOperationException(
-                'Requested receive_message after receiving a closing '
-                'handshake')
-
         msgs = []
         buf = self._buffer
 
@@ -277,15 +438,48 @@ class WebSocket(StreamBase):
             except Exception, e:
                 print e
 
+            if self._capture is not None and frame['payload'] is not None:
+                self._capture.record(capture.INBOUND, frame['opcode'], frame['payload'],
+                                     frame['fin'])
+
             if frame['payload'] == None:
                 # Incomplete/partial frame
                 if frame['left'] > 0:
                     break;
             elif frame['opcode'] == 0x8: # connection close
-                self._logger.debug('Received client-initiated closing handshake')
+                if self.closed:
+                    self._logger.debug('Received ack for server-initiated closing handshake')
+                    self.close_acknowledged = True
+                else:
+                    self._logger.debug('Received client-initiated closing handshake')
+                    self._send_closing_handshake(frame['close_code'])
+                buf = ''
                 break
+            elif frame['opcode'] == 0x9: # ping
+                if not self.closed:
+                    self._send_pong(frame['payload'])
+            elif frame['opcode'] == 0xA: # pong
+                if self._ping_sent is not None and frame['payload'] == self._ping_payload:
+                    self._rtt.sample(self._recv_time - self._ping_sent)
+                    self._ping_sent = None
+            elif self.closed:
+                # data sent by the client before it got our closing handshake
+                pass
             else:
-                msgs.append(frame['payload'])
+                try:
+                    message = self._reassemble(frame)
+                except InvalidUTF8Exception, e:
+                    self._logger.debug('Closing connection: %s', e)
+                    self._send_closing_handshake(const.STATUS_INVALID_FRAME_PAYLOAD_DATA)
+                    buf = ''
+                    break
+                except InvalidFrameException, e:
+                    self._logger.debug('Closing connection: %s', e)
+                    self._send_closing_handshake(const.STATUS_PROTOCOL_ERROR)
+                    buf = ''
+                    break
+                if message is not None:
+                    msgs.append(message)
 
             if frame['left']:
                 buf = buf[-frame['left']:]
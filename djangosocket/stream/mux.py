@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -
+
+"""
+Multiplexing subprotocol carrying many logical channels over a single hybi
+WebSocket connection.
+
+Every physical message starts with an operation and a channel id::
+
+    <op>,<channel id>,<payload>
+
+Supported operations:
+    sub - open a channel, the payload is the path of the view to route to
+    msg - message for an opened channel
+    uns - close a channel
+    crd - grant send credit (a number of messages) on a channel
+
+Both ends start with DJANGOSOCKET_MUX_INITIAL_CREDIT messages of credit per
+channel and must not send more messages than they have been granted.
+"""
+
+import copy
+import logging
+
+from eventlet import event
+from eventlet import queue
+from eventlet import spawn
+
+from djangosocket import db
+from djangosocket.conf import settings
+from djangosocket.registry import registry
+from djangosocket.stream import const
+from djangosocket.stream import hybi
+from djangosocket.stream.base import BadOperationException
+from djangosocket.stream.base import ConnectionTerminatedException
+
+OP_OPEN = 'sub'
+OP_MESSAGE = 'msg'
+OP_CLOSE = 'uns'
+OP_CREDIT = 'crd'
+
+_CLOSED = object()
+
+
+class LogicalChannel(object):
+    """
+    A logical channel of a multiplexed WebSocket. It exposes the same API as
+    a stream (send, iteration, closed) so that regular djangosocket views can
+    be served through it.
+    """
+
+    def __init__(self, websocket, channel_id, path, credit):
+        """
+        Construct an instance.
+
+        websocket: multiplexed WebSocket carrying the channel.
+        channel_id: id chosen by the client when opening the channel.
+        path: path the channel is routed to.
+        credit: initial number of messages each end may send.
+        """
+
+        self._websocket     = websocket
+        self._message_queue = queue.Queue()
+        self._window        = credit
+        self._recv_credit   = credit
+        self._consumed      = 0
+        self._send_credit   = credit
+        self._credit_event  = event.Event()
+        self._readable      = event.Event()
+        self.db_guard       = None
+        self.channel_id     = channel_id
+        self.path           = path
+        self._closed        = False
+
+    def _get_closed(self):
+        return self._closed
+
+    def _set_closed(self, value):
+        # closing a channel like a stream notifies the client, so that the
+        # channel doesn't linger in the connection and the registry
+        if value:
+            self.close()
+
+    closed = property(_get_closed, _set_closed)
+
+    def do_handshake(self):
+        """
+        Channels are opened by the client, there is no handshake to send.
+        """
+
+        pass
+
+    @property
+    def rtt(self):
+        """
+        Smoothed round-trip time of the underlying connection.
+        """
+
+        return self._websocket.rtt
+
+    @property
+    def rtt_variance(self):
+        """
+        Mean deviation of the round-trip time of the underlying connection.
+        """
+
+        return self._websocket.rtt_variance
+
+    def send(self, message, key=None, ttl=None, priority=None):
+        """
+        Send message on the channel, waiting for credit from the client if
+        the send window is exhausted. key, ttl and priority are those of
+        the physical connection send, keys being scoped to the channel.
+
+        Raises BadOperationException when called on a closed channel.
+        """
+
+        while self._send_credit <= 0 and not self.closed:
+            if self._credit_event.ready():
+                # senders waiting for the same grant share one event
+                self._credit_event = event.Event()
+            self._credit_event.wait()
+        if self.closed:
+            raise BadOperationException('Requested send on a closed channel')
+
+        self._send_credit -= 1
+        done = None
+        if key is not None or ttl is not None:
+            done = self._sent
+        if key is not None:
+            key = (self.channel_id, key)
+        self._websocket._send_frame(OP_MESSAGE, self.channel_id, message, key, ttl, priority,
+                                    done)
+
+    def _sent(self, written):
+        # the client only grants credit back for messages it received, give
+        # back that of messages replaced or expired in the outbound queue
+        if not written:
+            self._grant(1)
+
+    def close(self):
+        """
+        Close the channel and notify the client.
+        """
+
+        if self._closed:
+            return
+        self._terminate()
+        self._websocket._send_frame(OP_CLOSE, self.channel_id)
+
+    def _terminate(self):
+        """
+        Mark the channel closed and wake up any reader or writer.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        registry.unregister(self)
+        self._websocket._channels.pop(self.channel_id, None)
+        self._message_queue.put(_CLOSED)
+        if not self._credit_event.ready():
+            self._credit_event.send()
+        if not self._readable.ready():
+            self._readable.send()
+
+    def _deliver(self, message):
+        """
+        Queue a message received from the client. Returns False if the client
+        sent more messages than it was granted.
+        """
+
+        self._recv_credit -= 1
+        if self._recv_credit < 0:
+            return False
+        self._message_queue.put(message)
+        if not self._readable.ready():
+            self._readable.send()
+        return True
+
+    def _grant(self, credit):
+        """
+        Add send credit granted by the client.
+        """
+
+        self._send_credit += credit
+        if not self._credit_event.ready():
+            self._credit_event.send()
+
+    def _wait_readable(self):
+        """
+        Blocks until a message is queued or the channel gets closed,
+        without taking the message.
+        """
+
+        while self._message_queue.empty():
+            if self._readable.ready():
+                self._readable = event.Event()
+            self._readable.wait()
+
+    def _wait(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the oldest message
+        not yet processed. Credit is granted back to the client once half
+        of the window has been consumed.
+        """
+
+        guard = self.db_guard
+        if timeout == 0:
+            message = self._message_queue.get_nowait()
+        elif guard is not None and guard.used and self._message_queue.empty() and \
+            (timeout is None or timeout > guard.release_after):
+            # close database connections once the view has been waiting
+            # for a while, bursts of messages keep using them
+            try:
+                message = self._message_queue.get(timeout=guard.release_after)
+            except queue.Empty:
+                guard.idle()
+                if timeout is not None:
+                    timeout -= guard.release_after
+                message = self._message_queue.get(timeout=timeout)
+        else:
+            message = self._message_queue.get(timeout=timeout)
+        if message is _CLOSED:
+            # keep following waits failing
+            self._message_queue.put(_CLOSED)
+            raise ConnectionTerminatedException('Logical channel closed')
+
+        self._consumed += 1
+        if self._consumed * 2 >= self._window and not self.closed:
+            self._recv_credit += self._consumed
+            self._websocket._send_frame(OP_CREDIT, self.channel_id, str(self._consumed))
+            self._consumed = 0
+        if self.db_guard is not None:
+            self.db_guard.busy()
+        return message
+
+    def receive_many(self, max_count=None, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for messages and
+        returns every queued message at once, at most max_count. Returns
+        an empty list if none arrived in time.
+        """
+
+        messages = []
+        try:
+            messages.append(self._wait(timeout))
+            while max_count is None or len(messages) < max_count:
+                messages.append(self._wait(0))
+        except queue.Empty:
+            pass
+        except ConnectionTerminatedException:
+            if not messages:
+                raise
+        return messages
+
+    def poll(self, max_count=None):
+        """
+        Returns every message received so far, at most max_count.
+        """
+
+        return self.receive_many(max_count, 0)
+
+    def __iter__(self):
+        """
+        Use channel as iterator. Iteration stops when the channel or the
+        underlying connection gets closed.
+        """
+
+        while True:
+            try:
+                message = self._wait()
+            except:
+                return
+            yield message
+
+
+class WebSocket(hybi.WebSocket):
+    """
+    This class multiplexes logical channels over a hybi WebSocket.
+    """
+
+    def __init__(self, request, socket):
+        """
+        Construct an instance of WebSocket.
+
+        request: django request.
+        socket: django request websocket object.
+        """
+        super(WebSocket, self).__init__(request, socket)
+
+        self._logger = logging.getLogger('djangosocket.websocket')
+        self._protocol = const.MUX_PROTOCOL
+        self._channels = {}
+        self._handlers = None
+
+    def _send_frame(self, op, channel_id, payload='', key=None, ttl=None, priority=None,
+                    done=None):
+        """
+        Send a multiplexed frame on the physical connection, done being
+        called once it is written or dropped.
+        """
+
+        if self.closed:
+            if op != OP_MESSAGE:
+                # nothing left to notify once the connection is gone
+                return
+            raise BadOperationException(
+                'Requested send after sending out a closing handshake')
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        elif not isinstance(payload, str):
+            payload = str(payload)
+        self._send_message('%s,%s,%s' % (op, channel_id, payload), key, ttl, priority, done)
+
+    def serve(self, handlers=None):
+        """
+        Read physical messages and dispatch them to logical channels until
+        the connection gets closed.
+
+        handlers: optional dict mapping paths to views. By default channel
+        paths are resolved through the project urlconf.
+        """
+
+        self._handlers = handlers
+        try:
+            for message in self:
+                self._dispatch(message)
+        finally:
+            for channel in self._channels.values():
+                channel._terminate()
+
+    def _dispatch(self, message):
+        """
+        Route one physical message to its logical channel.
+        """
+
+        try:
+            op, channel_id, payload = message.split(',', 2)
+        except ValueError:
+            self._logger.debug('Ignoring malformed multiplexed frame: %r', message[:32])
+            return
+
+        channel = self._channels.get(channel_id)
+        if op == OP_OPEN:
+            if channel is None:
+                self._open_channel(channel_id, payload)
+        elif channel is None:
+            # messages may race with a server-initiated close
+            self._logger.debug('Ignoring %s frame for unknown channel %s', op, channel_id)
+        elif op == OP_MESSAGE:
+            if not channel._deliver(payload):
+                self._logger.debug('Channel %s exceeded its receive window', channel_id)
+                channel.close()
+        elif op == OP_CREDIT:
+            try:
+                channel._grant(int(payload))
+            except ValueError:
+                channel.close()
+        elif op == OP_CLOSE:
+            channel._terminate()
+
+    def _resolve(self, path):
+        """
+        Return (view, args, kwargs) serving path, or a None view.
+        """
+
+        if self._handlers is not None:
+            return self._handlers.get(path), (), {}
+
+        from django.core.urlresolvers import resolve, Resolver404
+        try:
+            view, args, kwargs = resolve(path)
+        except Resolver404:
+            return None, (), {}
+        return view, args, kwargs
+
+    def _open_channel(self, channel_id, path):
+        """
+        Open a logical channel and run the view it is routed to.
+        """
+
+        path = path.split('?', 1)[0]
+        view, args, kwargs = self._resolve(path)
+        if view is None or len(self._channels) >= settings.DJANGOSOCKET_MUX_MAX_CHANNELS or \
+            not (settings.DJANGOSOCKET_ACCEPT_ALL or getattr(view, 'accept_djangosocket', False)):
+            self._send_frame(OP_CLOSE, channel_id)
+            return
+
+        channel = LogicalChannel(self, channel_id, path,
+                                 settings.DJANGOSOCKET_MUX_INITIAL_CREDIT)
+        self._channels[channel_id] = channel
+        spawn(self._run_channel, channel, view, args, kwargs)
+
+    def _run_channel(self, channel, view, args, kwargs):
+        """
+        Call view with a copy of the request bound to the logical channel.
+        """
+
+        request = copy.copy(self._request)
+        request.path = request.path_info = channel.path
+        request.websocket = channel
+        request.is_websocket = lambda: True
+        registry.register(channel, request)
+        channel.db_guard = db.guard()
+        try:
+            view(request, *args, **kwargs)
+        except Exception:
+            self._logger.exception('Multiplexed view for %s failed', channel.path)
+        finally:
+            channel.close()
+            if channel.db_guard is not None:
+                channel.db_guard.idle()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -
+
+"""
+Outbound scheduling of encoded frames waiting to be written to a client.
+
+Frames are queued in three priority classes: control frames (close, ping,
+pong) go first, then interactive messages, then bulk messages. Bulk
+messages may be queued as an iterator of fragments; control frames are
+written between fragments while other messages wait for the fragmented
+message to complete, as fragments of different messages cannot be
+interleaved.
+
+Frames sent with a key replace the pending frame with the same key, keeping
+its place in the queue, so that a slow client receives the latest value of
+each key instead of a backlog of stale ones. Frames sent with a ttl are
+dropped unsent once they are older than ttl seconds. A frame may come with
+a done callback, called with True once it is written and with False if it
+gets replaced or dropped.
+"""
+
+import collections
+import time
+
+__all__ = ('OutboundQueue', 'OutboundScheduler',
+           'PRIORITY_CONTROL', 'PRIORITY_INTERACTIVE', 'PRIORITY_BULK')
+
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+# entry fields
+_KEY, _FRAME, _DEADLINE, _DONE = range(4)
+
+
+def _fragments(frames, done):
+    for frame in frames:
+        yield frame
+    done(True)
+
+
+class OutboundQueue(object):
+    """
+    FIFO of encoded frames, conflated by key and expiring after their ttl.
+    """
+
+    def __init__(self):
+        self._entries = collections.deque()
+        self._keys    = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, frame, key=None, ttl=None, done=None):
+        """
+        Queue frame, replacing the pending frame with the same key if any.
+        """
+
+        deadline = ttl is not None and time.time() + ttl or None
+        if key is not None:
+            entry = self._keys.get(key)
+            if entry is not None:
+                if entry[_DONE] is not None:
+                    entry[_DONE](False)
+                entry[_FRAME] = frame
+                entry[_DEADLINE] = deadline
+                entry[_DONE] = done
+                return
+        entry = [key, frame, deadline, done]
+        self._entries.append(entry)
+        if key is not None:
+            self._keys[key] = entry
+
+    def get(self):
+        """
+        Return (frame, done callback) of the oldest frame still alive, or
+        (None, None) if the queue is empty.
+        """
+
+        now = None
+        while self._entries:
+            entry = self._entries.popleft()
+            if entry[_KEY] is not None:
+                del self._keys[entry[_KEY]]
+            if entry[_DEADLINE] is not None:
+                now = now or time.time()
+                if entry[_DEADLINE] < now:
+                    if entry[_DONE] is not None:
+                        entry[_DONE](False)
+                    continue
+            return entry[_FRAME], entry[_DONE]
+        return None, None
+
+
+class OutboundScheduler(object):
+    """
+    Priority classes of outbound queues.
+    """
+
+    def __init__(self):
+        self._queues    = [OutboundQueue(), OutboundQueue(), OutboundQueue()]
+        self._fragments = None
+
+    def __len__(self):
+        return sum(map(len, self._queues)) + (self._fragments is not None)
+
+    def put(self, frame, priority=PRIORITY_INTERACTIVE, key=None, ttl=None, done=None):
+        """
+        Queue frame, a string or an iterator of fragments, in the priority
+        class.
+        """
+
+        if done is not None and not isinstance(frame, str):
+            # done once the last fragment got written
+            frame = _fragments(frame, done)
+        self._queues[priority].put(frame, key, ttl, done)
+
+    def get(self):
+        """
+        Return (frame, priority, done callback) of the next frame to write,
+        or (None, None, None) if nothing is waiting. The callback of a
+        fragmented message is called by the scheduler.
+        """
+
+        frame, done = self._queues[PRIORITY_CONTROL].get()
+        if frame is not None:
+            return frame, PRIORITY_CONTROL, done
+
+        if self._fragments is not None:
+            # a fragmented message must complete before any other message
+            for frame in self._fragments:
+                return frame, PRIORITY_BULK, None
+            self._fragments = None
+
+        for priority in (PRIORITY_INTERACTIVE, PRIORITY_BULK):
+            frame, done = self._queues[priority].get()
+            if frame is None:
+                continue
+            if isinstance(frame, str):
+                return frame, priority, done
+            self._fragments = iter(frame)
+            return self.get()
+        return None, None, None
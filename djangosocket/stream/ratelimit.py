@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -
+
+"""
+Token bucket rate limiting of inbound traffic.
+
+Connections are charged for the messages and bytes they send, per connection
+and per client IP. Buckets may go into debt: a stream stops reading from its
+socket until the debt is paid back, which pushes back on the client through
+TCP flow control instead of buffering its messages.
+"""
+
+import time
+
+from djangosocket.conf import settings
+
+__all__ = ('TokenBucket', 'RateLimiter', 'client_address', 'for_connection',
+           'POLICY_PAUSE', 'POLICY_CLOSE')
+
+# Stop reading from the socket until the client is back under its limits.
+POLICY_PAUSE = 'pause'
+# Close the connection as soon as the client runs over its limits.
+POLICY_CLOSE = 'close'
+
+# client IP -> [connection count, messages bucket, bytes bucket]
+_ip_buckets = {}
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at rate tokens per second, holding at most burst
+    seconds worth of tokens.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate     = float(rate)
+        self.capacity = self.rate * burst
+        self.tokens   = self.capacity
+        self.stamp    = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, amount, now=None):
+        """
+        Take amount tokens, possibly going into debt.
+        """
+
+        self._refill(now or time.time())
+        self.tokens -= amount
+
+    def delay(self, now=None):
+        """
+        Return the number of seconds until the bucket is out of debt.
+        """
+
+        self._refill(now or time.time())
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+def _bucket(rate, burst):
+    if not rate:
+        return None
+    return TokenBucket(rate, burst)
+
+
+class RateLimiter(object):
+    """
+    Rate limits of one connection: its own buckets and the buckets shared
+    with the other connections of the same client IP.
+    """
+
+    def __init__(self, address, policy):
+        """
+        Construct an instance.
+
+        address: client IP, or None to only limit the connection itself.
+        policy: POLICY_PAUSE or POLICY_CLOSE.
+        """
+
+        burst = settings.DJANGOSOCKET_RATE_LIMIT_BURST
+        self.policy = policy
+        self._address = address
+        self._message_buckets = filter(None, [_bucket(settings.DJANGOSOCKET_RATE_LIMIT_MESSAGES, burst)])
+        self._byte_buckets = filter(None, [_bucket(settings.DJANGOSOCKET_RATE_LIMIT_BYTES, burst)])
+
+        if address is not None:
+            shared = _ip_buckets.get(address)
+            if shared is None:
+                shared = _ip_buckets[address] = [
+                    0,
+                    _bucket(settings.DJANGOSOCKET_RATE_LIMIT_IP_MESSAGES, burst),
+                    _bucket(settings.DJANGOSOCKET_RATE_LIMIT_IP_BYTES, burst),
+                ]
+            shared[0] += 1
+            if shared[1] is not None:
+                self._message_buckets.append(shared[1])
+            if shared[2] is not None:
+                self._byte_buckets.append(shared[2])
+
+    def charge(self, messages, bytes):
+        """
+        Charge the connection for messages and bytes received.
+        """
+
+        now = time.time()
+        for bucket in self._message_buckets:
+            bucket.consume(messages, now)
+        for bucket in self._byte_buckets:
+            bucket.consume(bytes, now)
+
+    def delay(self):
+        """
+        Return the number of seconds to stop reading for the connection to
+        be back under all its limits.
+        """
+
+        now = time.time()
+        return max([b.delay(now) for b in self._message_buckets + self._byte_buckets] or [0])
+
+    def release(self):
+        """
+        Release the buckets shared with the client IP. Safe to call more
+        than once.
+        """
+
+        address, self._address = self._address, None
+        if address is None:
+            return
+        shared = _ip_buckets.get(address)
+        if shared is not None:
+            shared[0] -= 1
+            if shared[0] <= 0:
+                del _ip_buckets[address]
+
+
+def client_address(request, peer=None):
+    """
+    Return the IP of the client of request. Behind the proxies listed in
+    DJANGOSOCKET_RATE_LIMIT_TRUSTED_PROXIES it is the last address of
+    X-Forwarded-For that wasn't added by one of them, otherwise the peer
+    address.
+    """
+
+    meta = getattr(request, 'META', None) or {}
+    address = meta.get('REMOTE_ADDR') or peer
+    trusted = settings.DJANGOSOCKET_RATE_LIMIT_TRUSTED_PROXIES
+    if not trusted or address not in trusted:
+        return address
+    # each proxy appends the address it got the request from
+    for forwarded in reversed(meta.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        forwarded = forwarded.strip()
+        if not forwarded:
+            break
+        address = forwarded
+        if address not in trusted:
+            break
+    return address
+
+
+def for_connection(address):
+    """
+    Return the RateLimiter of a new connection from address, or None when
+    no limit is configured.
+    """
+
+    if not (settings.DJANGOSOCKET_RATE_LIMIT_MESSAGES or
+            settings.DJANGOSOCKET_RATE_LIMIT_BYTES or
+            settings.DJANGOSOCKET_RATE_LIMIT_IP_MESSAGES or
+            settings.DJANGOSOCKET_RATE_LIMIT_IP_BYTES):
+        return None
+    return RateLimiter(address, settings.DJANGOSOCKET_RATE_LIMIT_POLICY)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -
+
+"""
+Round-trip time estimation from ping/pong exchanges.
+
+Each connection smooths its samples like TCP does (RFC 6298): a smoothed
+RTT and its mean deviation, updated in place. Every sample also goes to a
+worker-wide histogram of fixed millisecond buckets, so that per-sample
+bookkeeping doesn't grow any structure.
+"""
+
+import array
+import bisect
+
+__all__ = ('RttEstimator', 'RttHistogram', 'histogram')
+
+# upper bounds of the histogram buckets in milliseconds, the last bucket
+# counts anything slower
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class RttHistogram(object):
+    """
+    Counts of RTT samples by bucket.
+    """
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = array.array('L', [0] * (len(self.bounds) + 1))
+
+    def add(self, rtt):
+        """
+        Count a sample of rtt seconds.
+        """
+
+        self.counts[bisect.bisect_left(self.bounds, rtt * 1000)] += 1
+
+    def buckets(self):
+        """
+        Return (upper bound in milliseconds, count) pairs, None being the
+        bound of the last bucket.
+        """
+
+        return zip(self.bounds + (None,), self.counts)
+
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """
+        Return the upper bound in milliseconds of the bucket holding the
+        p-th percentile, None when it is the last bucket or there are no
+        samples.
+        """
+
+        rank = self.total() * p / 100.0
+        seen = 0
+        for bound, count in self.buckets():
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def reset(self):
+        for i in xrange(len(self.counts)):
+            self.counts[i] = 0
+
+
+class RttEstimator(object):
+    """
+    Smoothed RTT and RTT variation of a connection, in seconds.
+    """
+
+    __slots__ = ('srtt', 'rttvar', 'samples')
+
+    def __init__(self):
+        self.srtt    = None
+        self.rttvar  = None
+        self.samples = 0
+
+    def sample(self, rtt):
+        """
+        Update the estimate with a sample of rtt seconds.
+        """
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+        histogram.add(rtt)
+
+
+histogram = RttHistogram()
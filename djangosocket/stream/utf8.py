@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -
+
+"""
+Incremental UTF-8 validation of text messages.
+"""
+
+import codecs
+import re
+
+__all__ = ('Utf8Validator', 'decode', 'is_ascii')
+
+_NON_ASCII = re.compile('[\x80-\xff]')
+# UTF-16 surrogates encoded in UTF-8 (U+D800 to U+DFFF), invalid UTF-8 that
+# the Python 2 codec accepts
+_SURROGATE = re.compile('\xed[\xa0-\xbf]')
+
+
+def is_ascii(data):
+    """
+    Return True if data only holds ASCII bytes. The scan runs in the regex
+    engine without decoding or allocating.
+    """
+
+    return _NON_ASCII.search(data) is None
+
+
+def decode(data):
+    """
+    Decode UTF-8 data, raising UnicodeDecodeError on invalid sequences
+    including encoded surrogates.
+    """
+
+    match = _SURROGATE.search(data)
+    if match is not None:
+        raise UnicodeDecodeError('utf-8', data, match.start(), match.end(), 'encoded surrogate')
+    return data.decode('utf-8')
+
+
+class Utf8Validator(object):
+    """
+    Validates a message fed fragment by fragment, sequences may be split
+    across fragments.
+    """
+
+    def __init__(self):
+        self._decoder = None
+        self._last    = ''
+
+    def feed(self, data, final=False):
+        """
+        Return False as soon as data makes the message invalid UTF-8.
+        """
+
+        if self._decoder is None:
+            if is_ascii(data):
+                return True
+            self._decoder = codecs.getincrementaldecoder('utf-8')()
+        # a surrogate may start at the end of the previous fragment
+        if _SURROGATE.search(data) or _SURROGATE.search(self._last + data[:1]):
+            return False
+        if data:
+            self._last = data[-1:]
+        try:
+            self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            return False
+        return True
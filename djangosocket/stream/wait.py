@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -
+
+"""
+Waiting on several websockets and events from a single greenthread.
+"""
+
+import time
+
+import eventlet
+from eventlet import event
+from eventlet import hubs
+from eventlet import queue
+
+from djangosocket.stream import ratelimit
+
+__all__ = ('wait_any',)
+
+
+def _watch_socket(websocket, ready):
+    limiter = websocket._ratelimit
+    if limiter is not None and limiter.policy == ratelimit.POLICY_PAUSE:
+        # a paused client is not read before it is back under its limits
+        delay = limiter.delay()
+        if delay:
+            eventlet.sleep(delay)
+    if websocket._receiving is not None:
+        # the pinger is reading, what it receives gets queued
+        websocket._await_read()
+    else:
+        # only wait for readability, reading is left to the caller's
+        # greenthread; the pinger waits meanwhile
+        websocket._receiving = event.Event()
+        try:
+            hubs.trampoline(websocket._socket.fileno(), read=True)
+        finally:
+            receiving, websocket._receiving = websocket._receiving, None
+            receiving.send()
+    ready.put(websocket)
+
+
+def _watch_channel(channel, ready):
+    channel._wait_readable()
+    ready.put(channel)
+
+
+def _is_channel(websocket):
+    # logical channels of a multiplexed connection have no socket of their own
+    return not hasattr(websocket, '_socket')
+
+
+def _has_messages(websocket):
+    if _is_channel(websocket):
+        return not websocket._message_queue.empty()
+    return bool(websocket._message_queue)
+
+
+def _watch_event(evt, ready):
+    evt.wait()
+    ready.put(evt)
+
+
+def wait_any(websockets, events=(), timeout=None):
+    """
+    Waits up to timeout seconds (forever if None) until at least one of the
+    websockets, or logical channels of multiplexed connections, has
+    messages to receive or is closed, or one of the eventlet events is
+    sent. Returns the lists of ready websockets and ready events, both
+    empty if the deadline passed first.
+
+    Messages of the ready websockets are then available without blocking
+    through poll() or receive_many().
+    """
+
+    deadline = timeout is not None and time.time() + timeout or None
+    ready = queue.Queue()
+    watchers = {}
+
+    def ready_now():
+        return ([ws for ws in websockets if _has_messages(ws) or ws.closed],
+                [evt for evt in events if evt.ready()])
+
+    try:
+        for evt in events:
+            watchers[evt] = eventlet.spawn(_watch_event, evt, ready)
+        while True:
+            ready_websockets, ready_events = ready_now()
+            if ready_websockets or ready_events:
+                return ready_websockets, ready_events
+
+            for websocket in websockets:
+                watcher = watchers.get(websocket)
+                if watcher is None or watcher.dead:
+                    watch = _is_channel(websocket) and _watch_channel or _watch_socket
+                    watchers[websocket] = eventlet.spawn(watch, websocket, ready)
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return [], []
+            try:
+                item = ready.get(timeout=remaining)
+            except queue.Empty:
+                return [], []
+            if item in websockets and not _is_channel(item):
+                # readable, parse what arrived without waiting for more
+                try:
+                    item._fill(time.time())
+                except Exception:
+                    # closed, reported as ready
+                    pass
+    finally:
+        for watcher in watchers.values():
+            watcher.kill()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -
+
+"""
+Tests of djangosocket, run with ``manage.py test djangosocket``. Connections
+are served over fake sockets recording what gets written.
+"""
+
+import eventlet
+from django.http import HttpRequest
+from django.utils import unittest
+
+from djangosocket.admission import admission
+from djangosocket.conf import settings
+from djangosocket.decorators import accept_djangosocket
+from djangosocket.registry import registry
+from djangosocket.stream import const
+from djangosocket.stream import mux
+
+
+class FakeSocket(object):
+    """
+    Socket recording written data, nothing is ever received.
+    """
+
+    def __init__(self):
+        self.written = []
+
+    def sendall(self, data):
+        self.written.append(data)
+
+    def getpeername(self):
+        return ('127.0.0.1', 50000)
+
+
+def mux_websocket(handlers):
+    request = HttpRequest()
+    request.path = request.path_info = '/'
+    request.META.update({
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_ORIGIN': 'http://testserver',
+        'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        'HTTP_SEC_WEBSOCKET_PROTOCOL': const.MUX_PROTOCOL,
+    })
+    websocket = mux.WebSocket(request, FakeSocket())
+    websocket._handlers = handlers
+    return websocket
+
+
+def run_greenthreads():
+    for i in xrange(10):
+        eventlet.sleep(0)
+
+
+class MuxChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.served = []
+
+        @accept_djangosocket
+        def view(request):
+            self.served.append(request.websocket)
+
+        self.websocket = mux_websocket({'/channel/': view})
+
+    def tearDown(self):
+        for channel in self.websocket._channels.values():
+            channel._terminate()
+
+    def test_returned_views_release_their_channel(self):
+        count = settings.DJANGOSOCKET_MUX_MAX_CHANNELS + 8
+        for channel_id in xrange(count):
+            self.websocket._dispatch('sub,%d,/channel/' % channel_id)
+            run_greenthreads()
+
+        self.assertEqual(len(self.served), count)
+        self.assertEqual(self.websocket._channels, {})
+        for channel in self.served:
+            self.assertTrue(channel.closed)
+            self.assertFalse(channel in registry)
+
+    def test_channels_skip_admission_control(self):
+        admission.draining = True
+        try:
+            self.websocket._dispatch('sub,1,/channel/')
+            run_greenthreads()
+        finally:
+            admission.draining = False
+
+        self.assertEqual(len(self.served), 1)
+        self.assertEqual(self.websocket._channels, {})
+
+    def test_conflated_sends_give_credit_back(self):
+        channel = mux.LogicalChannel(self.websocket, '1', '/channel/',
+                                     settings.DJANGOSOCKET_MUX_INITIAL_CREDIT)
+        self.websocket._channels['1'] = channel
+        count = settings.DJANGOSOCKET_MUX_INITIAL_CREDIT * 2
+        with eventlet.Timeout(1):
+            for i in xrange(count):
+                channel.send('price %d' % i, key='price')
+        # all but the last message were replaced while queued
+        self.assertEqual(channel._send_credit, settings.DJANGOSOCKET_MUX_INITIAL_CREDIT - 1)
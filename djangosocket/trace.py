@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -
+
+"""
+Instrumentation of the stream layer.
+
+Tracers registered with add_tracer are called after each handshake, socket
+recv, parse, dispatch (time spent by the view handling a message) and write
+as tracer(event, stream, duration, info). The hooks only cost a global flag
+check while no tracer is registered.
+
+HubWatchdog detects when the eventlet hub has not run for longer than a
+threshold, which means a greenthread is blocking the whole worker, and logs
+the stack of the offending code and the path of the last dispatched stream.
+SamplingProfiler periodically samples the stack of the worker. The durations
+of opening handshakes are always counted in handshakes.
+"""
+
+import logging
+import sys
+import time
+import traceback
+
+import eventlet
+from eventlet import patcher
+
+from djangosocket.stream.rtt import RttHistogram
+
+__all__ = ('add_tracer', 'remove_tracer', 'HubWatchdog', 'SamplingProfiler', 'handshakes',
+           'EVENT_HANDSHAKE', 'EVENT_RECV', 'EVENT_PARSE', 'EVENT_DISPATCH',
+           'EVENT_WRITE')
+
+EVENT_HANDSHAKE = 'handshake'
+EVENT_RECV = 'recv'
+EVENT_PARSE = 'parse'
+EVENT_DISPATCH = 'dispatch'
+EVENT_WRITE = 'write'
+
+logger = logging.getLogger('djangosocket.trace')
+
+# real OS threads, whatever eventlet monkey patched
+_thread = patcher.original('thread')
+_threading = patcher.original('threading')
+_time = patcher.original('time')
+
+# True when hooks have to run
+enabled = False
+# stream which was last handed a message
+active = None
+
+_tracers = []
+_watchdog = None
+
+
+class Timings(object):
+    """
+    Number, total and histogram of durations.
+    """
+
+    def __init__(self, bounds):
+        self.count     = 0
+        self.total     = 0.0
+        self.histogram = RttHistogram(bounds)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.histogram.add(duration)
+
+    def mean(self):
+        """
+        Return the mean duration in seconds.
+        """
+
+        return self.count and self.total / self.count or 0.0
+
+
+# opening handshakes of the worker, by buckets of milliseconds
+handshakes = Timings((0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+
+def _update():
+    global enabled
+    enabled = bool(_tracers) or _watchdog is not None
+
+
+def add_tracer(tracer):
+    """
+    Register tracer(event, stream, duration, info).
+    """
+
+    _tracers.append(tracer)
+    _update()
+
+
+def remove_tracer(tracer):
+    """
+    Unregister tracer.
+    """
+
+    if tracer in _tracers:
+        _tracers.remove(tracer)
+    _update()
+
+
+def emit(event, stream, start, **info):
+    """
+    Call tracers for event which started at start.
+    """
+
+    duration = time.time() - start
+    for tracer in _tracers:
+        try:
+            tracer(event, stream, duration, info)
+        except Exception:
+            logger.exception('Tracer %r failed', tracer)
+
+
+def describe(stream):
+    """
+    Return the path served by stream.
+    """
+
+    if stream is None:
+        return 'unknown'
+    request = getattr(stream, '_request', None)
+    return getattr(request, 'path', None) or getattr(stream, 'path', None) or repr(stream)
+
+
+class HubWatchdog(object):
+    """
+    Watches the hub from a real thread. A greenthread ticks every half
+    threshold; when ticks stop for longer than threshold seconds the stack
+    of the blocked worker is captured, and logged once the hub runs again.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._main     = None
+        self._last     = time.time()
+        self._report   = None
+
+    def start(self):
+        self._main = _thread.get_ident()
+        eventlet.spawn(self._tick)
+        watcher = _threading.Thread(target=self._watch, name='djangosocket-watchdog')
+        watcher.daemon = True
+        watcher.start()
+
+    def _tick(self):
+        while True:
+            now = time.time()
+            report = self._report
+            if report is not None:
+                self._report = None
+                logger.warning('Hub blocked for %dms, last dispatched to %s:\n%s',
+                               (now - self._last) * 1000, report[0], report[1])
+            self._last = now
+            eventlet.sleep(self.threshold / 2.0)
+
+    def _watch(self):
+        while True:
+            _time.sleep(self.threshold / 2.0)
+            if self._report is not None or _time.time() - self._last <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self._main)
+            if frame is not None:
+                self._report = (describe(active), ''.join(traceback.format_stack(frame)))
+
+
+def watchdog(threshold):
+    """
+    Start the worker watchdog, once.
+    """
+
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = HubWatchdog(threshold)
+        _watchdog.start()
+        _update()
+    return _watchdog
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the worker every interval seconds from a real
+    thread. Stacks are counted in the collapsed format of flame graph tools.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._counts  = {}
+        self._main    = None
+        self._running = False
+
+    def start(self):
+        self._main = _thread.get_ident()
+        self._running = True
+        sampler = _threading.Thread(target=self._sample, name='djangosocket-profiler')
+        sampler.daemon = True
+        sampler.start()
+
+    def stop(self):
+        self._running = False
+
+    def _sample(self):
+        while self._running:
+            _time.sleep(self.interval)
+            frame = sys._current_frames().get(self._main)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (code.co_filename, code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self._counts[key] = self._counts.get(key, 0) + 1
+
+    def stats(self):
+        """
+        Return (count, stack) pairs, most sampled first.
+        """
+
+        counts = dict(self._counts)
+        return sorted([(count, stack) for stack, count in counts.items()], reverse=True)
+
+    def collapsed(self):
+        """
+        Return samples as 'stack count' lines.
+        """
+
+        return '\n'.join(['%s %d' % (stack, count) for count, stack in self.stats()])
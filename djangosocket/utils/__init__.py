@@ -1 +1,11 @@
-# -*- coding: utf-8 -
\ No newline at end of file
+# -*- coding: utf-8 -
+
+
+def already_handled():
+    """
+    Return gunicorn's ALREADY_HANDLED marker. Gunicorn's worker module is
+    imported on first use rather than when djangosocket is imported.
+    """
+    
+    from gunicorn.workers.async import ALREADY_HANDLED
+    return ALREADY_HANDLED
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -
+
+"""
+Import time benchmark and budget check::
+
+    $ python -m djangosocket.utils.importtime --budget 100 djangosocket
+
+Each module is imported several times in a fresh interpreter and the best
+time is reported. The check fails when a module takes longer than the budget
+(in milliseconds) or pulls in a dependency meant to be loaded lazily.
+"""
+
+import subprocess
+import sys
+from optparse import OptionParser
+
+# dependencies that must only be imported on first use
+LAZY_MODULES = ('numpy', 'gunicorn.workers.async')
+
+_SNIPPET = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print elapsed
+print ','.join([m for m in %r if m in sys.modules])
+"""
+
+
+def measure(module, repeat=5):
+    """
+    Return (best import time in seconds, lazy modules imported) of module.
+    """
+
+    best, eager = None, []
+    for i in range(repeat):
+        process = subprocess.Popen([sys.executable, '-c', _SNIPPET % (module, LAZY_MODULES)],
+                                   stdout=subprocess.PIPE)
+        out = process.communicate()[0]
+        if process.returncode:
+            raise RuntimeError('Importing %s failed' % module)
+        elapsed, imported = out.splitlines()[-2:]
+        if best is None or float(elapsed) < best:
+            best = float(elapsed)
+        eager = filter(None, imported.split(','))
+    return best, eager
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [module ...]')
+    parser.add_option('--budget', type='float', default=None,
+                      help='Maximum import time in milliseconds.')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='Number of fresh interpreters per module.')
+    options, modules = parser.parse_args(argv)
+
+    failed = False
+    for module in modules or ['djangosocket']:
+        elapsed, eager = measure(module, options.repeat)
+        print '%s: %.1fms' % (module, elapsed * 1000)
+        if eager:
+            print '  imports %s eagerly' % ', '.join(eager)
+            failed = True
+        if options.budget is not None and elapsed * 1000 > options.budget:
+            print '  over budget of %.1fms' % options.budget
+            failed = True
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -
+
+"""
+Replay of captured websocket sessions against a running server::
+
+    $ python -m djangosocket.utils.playback --port 8000 --speed 2 captures/*.cap
+
+Sessions are opened at the same relative times as when they were captured
+and send their inbound frames with the captured pacing, divided by the
+speed factor; a speed of 0 sends everything as fast as possible. Sessions
+are replayed over hybi framing whatever protocol they were captured with.
+
+Reports message throughput and response latency percentiles, the latency
+of a frame being the delay until the next data frame from the server.
+"""
+
+import os
+import struct
+import sys
+import time
+from base64 import b64encode
+from optparse import OptionParser
+
+import eventlet
+from eventlet import event
+
+from djangosocket import capture
+
+_DATA_OPCODES = (0x0, 0x1, 0x2)
+
+
+class Stats(object):
+    """
+    Counters of a replay.
+    """
+
+    def __init__(self):
+        self.sent       = 0
+        self.received   = 0
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.failed     = 0
+        self.latencies  = []
+
+    def percentile(self, p):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+
+def encode_frame(opcode, payload, fin=True):
+    """
+    Return a client frame, masked with a null key. The FIN bit is cleared
+    on every fragment of a message but the last one if fin is False.
+    """
+
+    b1 = (fin and 0x80 or 0) | opcode
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', b1, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('>BBH', b1, 0x80 | 126, length)
+    else:
+        header = struct.pack('>BBQ', b1, 0x80 | 127, length)
+    # a null masking key leaves the payload as is, the server still unmasks
+    return header + '\x00\x00\x00\x00' + payload
+
+
+class Client(object):
+    """
+    Minimal hybi client of a replayed session.
+    """
+
+    def __init__(self, host, port, path, protocol=''):
+        self._socket = eventlet.connect((host, port))
+        self._buffer = ''
+        request = ['GET %s HTTP/1.1' % path,
+                   'Host: %s:%d' % (host, port),
+                   'Upgrade: websocket',
+                   'Connection: Upgrade',
+                   'Origin: http://%s' % host,
+                   'Sec-WebSocket-Key: %s' % b64encode(os.urandom(16)),
+                   'Sec-WebSocket-Version: 13']
+        if protocol:
+            request.append('Sec-WebSocket-Protocol: %s' % protocol)
+        self._socket.sendall('\r\n'.join(request) + '\r\n\r\n')
+
+        while '\r\n\r\n' not in self._buffer:
+            data = self._socket.recv(4096)
+            if not data:
+                raise IOError('Connection closed during handshake')
+            self._buffer += data
+        response, self._buffer = self._buffer.split('\r\n\r\n', 1)
+        if response.split(' ', 2)[1] != '101':
+            raise IOError('Handshake refused: %s' % response.splitlines()[0])
+
+    def send(self, opcode, payload, fin=True):
+        frame = encode_frame(opcode, payload, fin)
+        self._socket.sendall(frame)
+        return len(frame)
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            data = self._socket.recv(65536)
+            if not data:
+                raise EOFError()
+            self._buffer += data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def receive(self):
+        """
+        Return the (opcode, payload) of the next frame.
+        """
+
+        b1, b2 = map(ord, self._read(2))
+        length = b2 & 0x7f
+        if length == 126:
+            length = struct.unpack('>H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', self._read(8))[0]
+        return b1 & 0x0f, self._read(length)
+
+    def close(self):
+        self._socket.close()
+
+
+def replay_session(session, start, host, port, speed, stats, close_timeout=5):
+    """
+    Replay session starting at timestamp start.
+    """
+
+    try:
+        client = Client(host, port, session.path, session.protocol)
+    except EnvironmentError, e:
+        print >> sys.stderr, 'Session %s failed: %s' % (session.path, e)
+        stats.failed += 1
+        return
+
+    pending = []
+    closed = event.Event()
+
+    def reader():
+        try:
+            while True:
+                opcode, payload = client.receive()
+                if opcode == 0x8:
+                    break
+                stats.received += 1
+                stats.bytes_recv += len(payload)
+                if opcode in _DATA_OPCODES and pending:
+                    stats.latencies.append(time.time() - pending[0])
+                    del pending[:]
+        except (EOFError, EnvironmentError):
+            pass
+        closed.send()
+
+    reading = eventlet.spawn(reader)
+    try:
+        for timestamp, kind, opcode, fin, payload in session.frames:
+            if kind != capture.INBOUND or opcode == 0x8:
+                continue
+            if speed:
+                delay = start + (timestamp - session.start) / speed - time.time()
+                if delay > 0:
+                    eventlet.sleep(delay)
+            if closed.ready():
+                break
+            if opcode in _DATA_OPCODES and not pending:
+                pending.append(time.time())
+            stats.bytes_sent += client.send(opcode, payload, fin)
+            if fin:
+                stats.sent += 1
+
+        if not closed.ready():
+            client.send(0x8, struct.pack('>H', 1000))
+        with eventlet.Timeout(close_timeout, False):
+            closed.wait()
+    finally:
+        reading.kill()
+        client.close()
+
+
+def replay(sessions, host='127.0.0.1', port=8000, speed=1.0):
+    """
+    Replay sessions concurrently and return (Stats, elapsed seconds).
+    """
+
+    stats = Stats()
+    if not sessions:
+        return stats, 0.0
+
+    pool = eventlet.GreenPool(len(sessions))
+    origin = sessions[0].start
+    begin = time.time()
+    for session in sessions:
+        if speed:
+            start = begin + (session.start - origin) / speed
+            eventlet.sleep(max(start - time.time(), 0))
+        else:
+            start = time.time()
+        pool.spawn_n(replay_session, session, start, host, port, speed, stats)
+    pool.waitall()
+    return stats, time.time() - begin
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] capture ...')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--speed', type='float', default=1.0,
+                      help='Replay speed factor, 0 for as fast as possible.')
+    options, paths = parser.parse_args(argv)
+    if not paths:
+        parser.error('no capture file given')
+
+    sessions = capture.sessions(paths)
+    stats, elapsed = replay(sessions, options.host, options.port, options.speed)
+
+    print 'sessions: %d (%d failed)' % (len(sessions), stats.failed)
+    print 'elapsed: %.2fs' % elapsed
+    print 'sent: %d messages, %d bytes' % (stats.sent, stats.bytes_sent)
+    print 'received: %d messages, %d bytes' % (stats.received, stats.bytes_recv)
+    if elapsed:
+        print 'throughput: %.1f messages/s' % ((stats.sent + stats.received) / elapsed)
+    for p in (50, 90, 99, 100):
+        latency = stats.percentile(p)
+        if latency is not None:
+            print 'latency p%d: %.1fms' % (p, latency * 1000)
+    return stats.failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -
+
+from django.http import HttpResponseBadRequest
+
+from djangosocket.decorators import require_djangosocket
+from djangosocket.stream.mux import WebSocket as MultiplexedWebSocket
+
+__all__ = ('multiplex',)
+
+
+@require_djangosocket
+def multiplex(request):
+    """
+    Serve the logical channels of a multiplexed websocket, each channel being
+    routed to the view matching its path in the project urlconf.
+    """
+    
+    if not isinstance(request.websocket, MultiplexedWebSocket):
+        # client did not negotiate the djangosocket-mux subprotocol
+        return HttpResponseBadRequest()
+    request.websocket.serve()
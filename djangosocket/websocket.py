@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -
 
+from djangosocket.stream import const
+
+
 class MalformedWebSocket(ValueError):
     pass
     
@@ -11,6 +14,7 @@ def setup_djangosocket(request):
     
     - hixie76 protocol (Safari 5+)
     - hybi protocol (Chrome 13+)
+    - djangosocket-mux subprotocol over hybi (logical channels)
     """
     
     if request.META.get('HTTP_CONNECTION', '').lower() == 'upgrade' and \
@@ -19,8 +23,12 @@ def setup_djangosocket(request):
         socket = request.META['gunicorn.socket']
         try:
             ver = request.META.get('HTTP_SEC_WEBSOCKET_VERSION')
+            protocols = [p.strip() for p in
+                         request.META.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',')]
             
-            if ver:
+            if ver and const.MUX_PROTOCOL in protocols:
+                from djangosocket.stream.mux import WebSocket
+            elif ver:
                 from djangosocket.stream.hybi import WebSocket
             else:
                 from djangosocket.stream.hixie76 import WebSocket